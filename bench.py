@@ -0,0 +1,185 @@
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+from itertools import batched
+from pathlib import Path
+
+import cv2
+import numpy as np
+from extractor.gen import compose_image, load_pool, seeded
+from extractor.yolo import BACKEND as YOLO_BACKEND
+from extractor.yolo import IMGSZ, find_card_obboxes_batch, warp_card
+from matcher.index import INDEX_TYPE, SEARCH_PARAMS, SearchIndex, card_id
+
+# Same package run.py serves, the hyphen keeps it from being imported by name
+models = importlib.import_module("tiny-embed-server.models")
+
+K = 9
+IOU = 0.5  # a ground truth card counts as detected above this overlap
+
+
+def corpus(n: int, seed: int) -> list[tuple[np.ndarray, list[tuple[str, np.ndarray]]]]:
+    # Every image gets its own seed, so image i is the same whatever n is
+    pool = load_pool(seed)
+    return [compose_image(seeded(seed, "bench", index), pool) for index in range(n)]
+
+
+def iou(a: np.ndarray, b: np.ndarray) -> float:
+    a, b = a.astype(np.float32), b.astype(np.float32)
+    overlap, _ = cv2.intersectConvexConvex(cv2.convexHull(a), cv2.convexHull(b))
+    union = cv2.contourArea(cv2.convexHull(a)) + cv2.contourArea(cv2.convexHull(b)) - overlap
+
+    return overlap / union if union > 0 else 0.0
+
+
+def assign(truth: list[tuple[str, np.ndarray]], boxes: list[np.ndarray]) -> list[int | None]:
+    # Greedy one to one matching, ground truth card -> detected box
+    pairs = sorted(
+        ((iou(corners, box), t, d) for t, (_, corners) in enumerate(truth) for d, box in enumerate(boxes)),
+        reverse=True,
+    )
+
+    matched: list[int | None] = [None] * len(truth)
+    used: set[int] = set()
+
+    for overlap, t, d in pairs:
+        if overlap < IOU:
+            break
+
+        if matched[t] is None and d not in used:
+            matched[t] = d
+            used.add(d)
+
+    return matched
+
+
+def percentiles(timings: list[float], unit: int) -> dict:
+    if not timings:
+        return {"count": 0}
+
+    ms = np.array(timings) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+
+    return {
+        "count": len(timings),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "per_s": round(unit / float(np.sum(timings)), 1) if np.sum(timings) else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end latency and accuracy on a synthetic, seeded corpus")
+    parser.add_argument("-n", type=int, default=200, help="synthetic images to generate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch", type=int, default=8, help="images per detection batch and search batch")
+    parser.add_argument("--embed-batch", type=int, default=32, help="crops per embedding batch")
+    parser.add_argument("--out", type=Path, help="also write the JSON report here")
+    args = parser.parse_args()
+
+    images = corpus(args.n, args.seed)
+    cards = sum(len(truth) for _, truth in images)
+
+    index = SearchIndex.open()
+    embed = models.load()
+
+    # Warm-up, so the first batch doesn't pay for loading, exporting or compiling
+    find_card_obboxes_batch([images[0][0]])
+    embed(models.pixel_values([np.zeros((680, 488, 3), dtype=np.uint8)]))
+
+    detect_times, embed_times, search_times = [], [], []
+    started = time.perf_counter()
+
+    # Per image: boxes found, and the crops to embed for matched ground truth
+    found: list[list[np.ndarray]] = []
+
+    for chunk in batched(images, args.batch):
+        start = time.perf_counter()
+        found += find_card_obboxes_batch([image for image, _ in chunk])
+        detect_times.append(time.perf_counter() - start)
+
+    crops = []
+    expected = []
+    detected = 0
+
+    for (image, truth), boxes in zip(images, found):
+        for (name, _), match in zip(truth, assign(truth, boxes)):
+            if match is None:
+                continue
+
+            detected += 1
+            crops.append(cv2.cvtColor(warp_card(image, boxes[match]), cv2.COLOR_BGR2RGB))
+            expected.append(card_id(name))
+
+    embeddings = []
+
+    for chunk in batched(crops, args.embed_batch):
+        start = time.perf_counter()
+        embeddings.append(embed(models.pixel_values(list(chunk))))
+        embed_times.append(time.perf_counter() - start)
+
+    embeddings = np.concatenate(embeddings) if embeddings else np.empty((0, models.DIMENSIONS), np.float32)
+    ids = np.empty((0, K), dtype=str)
+
+    for chunk in batched(range(len(embeddings)), args.batch * 4):
+        start = time.perf_counter()
+        _, chunk_ids = index.search(embeddings[list(chunk)], K)
+        search_times.append(time.perf_counter() - start)
+        ids = np.concatenate([ids, chunk_ids]) if len(ids) else chunk_ids
+
+    elapsed = time.perf_counter() - started
+
+    top1 = sum(row[0] == card for row, card in zip(ids.tolist(), expected))
+    topk = sum(card in row for row, card in zip(ids.tolist(), expected))
+    boxes = sum(len(each) for each in found)
+
+    report = {
+        "config": {
+            "n": args.n,
+            "seed": args.seed,
+            "batch": args.batch,
+            "embed_batch": args.embed_batch,
+            "yolo_backend": YOLO_BACKEND,
+            "yolo_imgsz": IMGSZ,
+            "embed_backend": models.BACKEND,
+            "index": INDEX_TYPE,
+            "search_params": SEARCH_PARAMS,
+            "index_version": index.version,
+            "threads": os.cpu_count(),
+        },
+        "latency": {
+            "detect_per_batch": percentiles(detect_times, args.n),
+            "embed_per_batch": percentiles(embed_times, len(crops)),
+            "search_per_batch": percentiles(search_times, len(crops)),
+        },
+        "throughput": {
+            "images_per_s": round(args.n / elapsed, 2),
+            "cards_per_s": round(cards / elapsed, 2),
+        },
+        "accuracy": {
+            "cards": cards,
+            "detection_recall": round(detected / cards, 4) if cards else None,
+            "detection_precision": round(detected / boxes, 4) if boxes else None,
+            # Of the cards that were detected
+            "top1": round(top1 / detected, 4) if detected else None,
+            f"top{K}": round(topk / detected, 4) if detected else None,
+            # Of all cards, a missed detection counts as a miss
+            "end_to_end_top1": round(top1 / cards, 4) if cards else None,
+        },
+    }
+
+    output = json.dumps(report, indent=2)
+    print(output)
+
+    if args.out:
+        args.out.write_text(output + "\n")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
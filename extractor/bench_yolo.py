@@ -0,0 +1,112 @@
+import argparse
+import json
+import sys
+import time
+from itertools import batched
+from pathlib import Path
+
+import cv2
+import numpy as np
+from extractor.yolo import BATCH, find_card_obboxes_batch
+
+BACKENDS = ["torch", "onnx", "openvino"]
+
+
+def load(fixtures: Path) -> list[tuple[str, np.ndarray]]:
+    paths = sorted(path for path in fixtures.iterdir() if path.suffix.lower() in {".jpg", ".jpeg", ".png"})
+    return [(path.name, cv2.imread(str(path))) for path in paths]
+
+
+def compare(reference: list[np.ndarray], boxes: list[np.ndarray], diagonal: float) -> float | None:
+    # Largest corner offset between matched boxes relative to the image
+    # diagonal, None when the backends don't even find the same number of cards
+    if len(reference) != len(boxes):
+        return None
+
+    worst = 0.0
+    remaining = list(boxes)
+
+    for expected in reference:
+        nearest = min(remaining, key=lambda box: np.linalg.norm(box.mean(axis=0) - expected.mean(axis=0)))
+        remaining = [box for box in remaining if box is not nearest]
+
+        worst = max(worst, float(np.linalg.norm(nearest - expected, axis=1).max()) / diagonal)
+
+    return worst
+
+
+def latency(backend: str, images: list[np.ndarray], batch: int, repeat: int) -> dict:
+    # First call loads, exports or compiles the model
+    find_card_obboxes_batch(images[:1], backend)
+
+    timings = []
+
+    for _ in range(repeat):
+        for chunk in batched(images, batch):
+            start = time.perf_counter()
+            find_card_obboxes_batch(list(chunk), backend)
+            timings.append((time.perf_counter() - start) / len(chunk))
+
+    timings = np.array(timings) * 1000
+
+    return {
+        "backend": backend,
+        "batch": batch,
+        "p50_ms_per_image": round(float(np.percentile(timings, 50)), 2),
+        "p99_ms_per_image": round(float(np.percentile(timings, 99)), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Box parity and latency of YOLO backends against the torch model")
+    parser.add_argument("fixtures", type=Path, help="directory of photos with cards in them")
+    parser.add_argument("--backends", nargs="+", default=BACKENDS, choices=BACKENDS)
+    parser.add_argument("--tolerance", type=float, default=0.01, help="max corner offset, relative to the diagonal")
+    parser.add_argument("--batch", type=int, default=BATCH, help="batch size for the batched latency run")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    fixtures = load(args.fixtures)
+    names = [name for name, _ in fixtures]
+    images = [image for _, image in fixtures]
+
+    results = []
+    failed = False
+
+    reference = find_card_obboxes_batch(images, "torch")
+
+    for backend in args.backends:
+        if backend != "torch":
+            found = find_card_obboxes_batch(images, backend)
+
+            for name, image, expected, boxes in zip(names, images, reference, found):
+                error = compare(expected, boxes, float(np.hypot(*image.shape[:2])))
+                ok = error is not None and error <= args.tolerance
+                failed |= not ok
+
+                results.append(
+                    {
+                        "backend": backend,
+                        "image": name,
+                        "cards": len(boxes),
+                        "expected": len(expected),
+                        "max_offset": None if error is None else round(error, 5),
+                        "ok": ok,
+                    }
+                )
+
+        for batch in sorted({1, args.batch}):
+            results.append(latency(backend, images, batch, args.repeat))
+
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print("  ".join(f"{key}={value}" for key, value in result.items()))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,42 @@
-from pathlib import Path
-from uuid import uuid4
+import numpy as np
+from cv2 import COLOR_BGR2RGB, IMREAD_COLOR, cvtColor, imdecode, imencode, imread
 
-from cv2 import imread, imwrite
+from .yolo import BACKEND, CONF, IMGSZ, MODEL, find_card_obboxes, find_card_obboxes_batch, warp_card
 
-from .yolo import crop_card_obbox
 
-TMP = Path(".tmp")
-TMP.mkdir(exist_ok=True)
+def find_all_cards_from_obbox(image: str) -> list[list[list[float]]]:
+    # Boxes only, crops are warped on demand by encode_crop
+    return [points.tolist() for points in find_card_obboxes(imread(image))]
 
 
-def find_all_cards_from_obbox(image: str, debug=False):
-    original = imread(image)
+def find_all_cards_in_memory(data: bytes) -> tuple[list[list[list[float]]], list[np.ndarray]]:
+    [found] = find_all_cards_in_memory_batch([data])
+    return found
 
-    ids: list[str] = []
 
-    for img in crop_card_obbox(original, debug):
-        id = str(TMP / f"{uuid4()}.jpg")
-        imwrite(id, img)
-        ids.append(id)
+def find_all_cards_in_memory_batch(
+    data: list[bytes],
+) -> list[tuple[list[list[list[float]]], list[np.ndarray]]]:
+    # Boxes plus RGB crops ready for the embedding processor, nothing touches disk.
+    # Detection runs batched across the photos.
+    originals = [imdecode(np.frombuffer(each, dtype=np.uint8), IMREAD_COLOR) for each in data]
+    found = []
 
-    return ids
+    for original, boxes in zip(originals, find_card_obboxes_batch(originals)):
+        crops = [cvtColor(warp_card(original, points), COLOR_BGR2RGB) for points in boxes]
+        found.append(([points.tolist() for points in boxes], crops))
+
+    return found
+
+
+def encode_crop(image: str, points: list[list[float]]) -> bytes:
+    ok, data = imencode(".jpg", warp_card(imread(image), np.array(points, dtype=np.float32)))
+    assert ok
+
+    return data.tobytes()
+
+
+def detector_version() -> str:
+    # Changes whenever the YOLO weights or anything that moves the boxes do
+    stat = MODEL.stat()
+    return f"{MODEL.name}:{stat.st_size}:{stat.st_mtime_ns}:{BACKEND}:{IMGSZ}:{CONF}"
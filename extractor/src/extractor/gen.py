@@ -1,18 +1,72 @@
+import argparse
+import json
+import multiprocessing
+import os
 import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 from pathlib import Path
+from typing import NamedTuple
 
 import cv2
 import numpy as np
 
-# random.seed(42)
-
-
 BACKGROUNDS = Path("images/unsplash_background_textures")
 CACHE = Path.home() / ".cache/third-eye"
 IMAGES = CACHE / "images"
 
-card_images = list(sorted(IMAGES.glob("*.jpg")))
-backgrounds = list(sorted(BACKGROUNDS.glob("*.jpg")))
+INTERMEDIATE_SIZE = 2000
+TARGET_SIZE = 640
+SCALE_FACTOR = TARGET_SIZE / INTERMEDIATE_SIZE
+
+# Decoded cards kept in memory, each image picks from these
+CARD_POOL = 1000
+CHUNK_SIZE = 32
+
+# Magenta fill rotate() leaves around the card
+KEY_LOWER = np.array([240, 0, 240], dtype=np.uint8)
+KEY_UPPER = np.array([255, 15, 255], dtype=np.uint8)
+
+
+class Pool(NamedTuple):
+    backgrounds: list[np.ndarray]
+    cards: list[tuple[str, np.ndarray]]
+
+
+# Loaded before the workers fork, so they share it instead of each reading the disk
+decoded: Pool | None = None
+
+
+def decode(path: Path, size: tuple[int, int] | None = None) -> np.ndarray:
+    img = cv2.imread(str(path))
+
+    if img is None:
+        raise ValueError(f"Could not decode {path}")
+
+    return img if size is None else cv2.resize(img, size)
+
+
+def load_pool(seed: int, cards: int = CARD_POOL) -> Pool:
+    background_paths = sorted(BACKGROUNDS.glob("*.jpg"))
+    card_paths = sorted(IMAGES.glob("*.jpg"))
+
+    if not background_paths or not card_paths:
+        raise FileNotFoundError(f"Need backgrounds in {BACKGROUNDS} and card images in {IMAGES}")
+
+    # Sampled from the seed alone, so the pool doesn't depend on the worker count
+    card_paths = random.Random(seed).sample(card_paths, min(cards, len(card_paths)))
+
+    # cv2 releases the GIL while decoding
+    with ThreadPoolExecutor() as threads:
+        backgrounds = list(threads.map(decode, background_paths, repeat((INTERMEDIATE_SIZE, INTERMEDIATE_SIZE))))
+        images = list(threads.map(decode, card_paths))
+
+    return Pool(backgrounds, [(path.stem, img) for path, img in zip(card_paths, images)])
+
+
+def seeded(seed: int, split: str, index: int) -> random.Random:
+    # Every image has its own generator, the same whichever worker makes it
+    return random.Random(f"{seed}/{split}/{index}")
 
 
 def rotate(img: cv2.typing.MatLike, angle: float):
@@ -73,16 +127,16 @@ def calculate_corners(h, w, M: None | cv2.typing.MatLike):
     return order_points(transformed_corners)
 
 
-def random_transform_card(img: cv2.typing.MatLike):
+def random_transform_card(img: cv2.typing.MatLike, rng: random.Random):
     h, w = img.shape[:2]
     M = None
 
-    if random.random() < 0.5:
-        angle = random.uniform(-30, 30)
+    if rng.random() < 0.5:
+        angle = rng.uniform(-30, 30)
         img, M = rotate(img, angle)
 
-    if random.random() < 0.3:
-        kernel_size = random.choice([3, 5, 7, 9])
+    if rng.random() < 0.3:
+        kernel_size = rng.choice([3, 5, 7, 9])
         img = cv2.GaussianBlur(img, (kernel_size, kernel_size), 0)
 
     return img, calculate_corners(h, w, M)
@@ -92,54 +146,47 @@ def overlay(bg, img, x, y):
     h, w = img.shape[:2]
     roi = bg[y : y + h, x : x + w]
 
-    lower = np.array([240, 0, 240])
-    upper = np.array([255, 15, 255])
-    mask = cv2.inRange(img, lower, upper)
-    mask_inv = cv2.bitwise_not(mask)
+    # Copies the card pixels straight into the background view
+    card = cv2.inRange(img, KEY_LOWER, KEY_UPPER) == 0
+    np.copyto(roi, img, where=card[..., None])
 
-    bg_part = cv2.bitwise_and(roi, roi, mask=mask)
-    card_part = cv2.bitwise_and(img, img, mask=mask_inv)
-
-    dst = cv2.add(bg_part, card_part)
-    bg[y : y + h, x : x + w] = dst
     return bg
 
 
-def save_yolo_obb(label: Path, corners):
-    with open(label, "a") as f:
-        coordinates = " ".join(f"{x:.6f} {y:.6f}" for x, y in corners)
-        f.write(f"0 {coordinates}\n")
-
+def yolo_obb(corners) -> str:
+    coordinates = " ".join(f"{x:.6f} {y:.6f}" for x, y in corners)
+    return f"0 {coordinates}\n"
 
-INTERMEDIATE_SIZE = 2000
-TARGET_SIZE = 640
-SCALE_FACTOR = TARGET_SIZE / INTERMEDIATE_SIZE
 
+def compose_image(
+    rng: random.Random, pool: Pool, debug=False
+) -> tuple[cv2.typing.MatLike, list[tuple[str, np.ndarray]]]:
+    # The final image plus, per pasted card, its image name (card id, with a
+    # face suffix for double faced cards) and its corners in final pixels
+    bg = rng.choice(pool.backgrounds).copy()
 
-def make_image(label: Path, image: Path, debug=False):
-    bg = cv2.imread(str(random.choice(backgrounds)))
-    bg = cv2.resize(bg, (INTERMEDIATE_SIZE, INTERMEDIATE_SIZE))
+    cards: list[tuple[str, np.ndarray]] = []
 
-    for _ in range(random.randint(1, 6)):
-        img = cv2.imread(str(random.choice(card_images)))
-        img, corners = random_transform_card(img)
+    for _ in range(rng.randint(1, 6)):
+        name, img = rng.choice(pool.cards)
+        img, corners = random_transform_card(img, rng)
 
         bg_h, bg_w = bg.shape[:2]
         card_h, card_w = img.shape[:2]
 
         margin = 20
-        x = random.randint(margin, bg_w - card_w - margin)
-        y = random.randint(margin, bg_h - card_h - margin)
+        x = rng.randint(margin, bg_w - card_w - margin)
+        y = rng.randint(margin, bg_h - card_h - margin)
 
         overlay(bg, img, x, y)
 
-        corners = (corners + np.array([x, y])) * SCALE_FACTOR / TARGET_SIZE
-        save_yolo_obb(label, corners)
+        corners = (corners + np.array([x, y])) * SCALE_FACTOR
+        cards.append((name, corners))
 
         if debug:
             for index, (cx, cy) in enumerate(corners):
-                cx = cx * TARGET_SIZE / SCALE_FACTOR
-                cy = cy * TARGET_SIZE / SCALE_FACTOR
+                cx = cx / SCALE_FACTOR
+                cy = cy / SCALE_FACTOR
 
                 cv2.circle(bg, (int(cx), int(cy)), 15, (0, 0, 255), -1)
                 cv2.putText(
@@ -154,40 +201,94 @@ def make_image(label: Path, image: Path, debug=False):
 
     bg = cv2.resize(bg, (TARGET_SIZE, TARGET_SIZE))
 
+    return bg, cards
+
+
+def make_image(label: Path, image: Path, rng: random.Random, pool: Pool, debug=False):
+    bg, cards = compose_image(rng, pool, debug)
+
     if debug:
         cv2.imshow("Final", bg)
         cv2.waitKey(0)
+        return
+
+    tmp = image.with_suffix(".tmp.jpg")
+    cv2.imwrite(str(tmp), bg)
+    tmp.replace(image)
+
+    # Written last, a label marks its image as done when resuming
+    tmp = label.with_suffix(".tmp")
+    tmp.write_text("".join(yolo_obb(corners / TARGET_SIZE) for _, corners in cards))
+    tmp.replace(label)
 
-    else:
-        cv2.imwrite(str(image), bg)
 
+def paths(root: Path, split: str, index: int) -> tuple[Path, Path]:
+    return root / "labels" / split / f"{index:05d}.txt", root / "images" / split / f"{index:05d}.jpg"
 
-def gen_images():
-    DATA = Path("dataset")
 
-    LABELS = DATA / "labels"
-    IMAGES = DATA / "images"
+def generate(root: Path, split: str, index: int, seed: int):
+    assert decoded is not None
+    make_image(*paths(root, split, index), seeded(seed, split, index), decoded)
 
-    LABELS_TRAIN = LABELS / "train"
-    LABELS_VAL = LABELS / "val"
 
-    IMAGES_TRAIN = IMAGES / "train"
-    IMAGES_VAL = IMAGES / "val"
+def gen_images(root: Path, splits: dict[str, int], seed: int, cards: int, workers: int | None, resume=True):
+    global decoded
 
-    LABELS_TRAIN.mkdir(parents=True, exist_ok=True)
-    LABELS_VAL.mkdir(parents=True, exist_ok=True)
-    IMAGES_TRAIN.mkdir(parents=True, exist_ok=True)
-    IMAGES_VAL.mkdir(parents=True, exist_ok=True)
+    # Resuming with another seed or pool would mix two datasets
+    config = {"seed": seed, "cards": cards}
+    meta = root / "gen.json"
 
-    for index in range(1, 11):
-        label = LABELS_TRAIN / f"{index:05d}.txt"
-        image = IMAGES_TRAIN / f"{index:05d}.jpg"
-        make_image(label, image, debug=True)
+    if resume and meta.exists() and json.loads(meta.read_text()) != config:
+        raise SystemExit(f"{root} was generated with {meta.read_text().strip()}, pass --force to start over")
 
-    # for index in range(1, 51):
-    #    label = LABELS_VAL / f"{index:05d}.txt"
-    #    image = IMAGES_VAL / f"{index:05d}.jpg"
-    #    make_image(label, image, debug=True)
+    for split in splits:
+        (root / "labels" / split).mkdir(parents=True, exist_ok=True)
+        (root / "images" / split).mkdir(parents=True, exist_ok=True)
 
+    meta.write_text(json.dumps(config) + "\n")
 
-gen_images()
+    todo = [
+        (split, index)
+        for split, count in splits.items()
+        for index in range(1, count + 1)
+        if not (resume and paths(root, split, index)[0].exists())
+    ]
+
+    if not todo:
+        print("Nothing to generate")
+        return
+
+    decoded = load_pool(seed, cards)
+    splits_todo, indexes = zip(*todo)
+
+    # Forked, so the workers share the decoded pool rather than pickling it
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        results = pool.map(generate, repeat(root), splits_todo, indexes, repeat(seed), chunksize=CHUNK_SIZE)
+
+        for done, _ in enumerate(results, 1):
+            print(f"{done}/{len(todo)} images generated", end="\r")
+
+    print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic YOLO OBB dataset of cards on backgrounds")
+    parser.add_argument("--out", type=Path, default=Path("dataset"))
+    parser.add_argument("--train", type=int, default=10_000, help="images in the train split")
+    parser.add_argument("--val", type=int, default=1_000, help="images in the val split")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cards", type=int, default=CARD_POOL, help="card images decoded into the pool")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--force", action="store_true", help="regenerate images that already exist")
+    parser.add_argument("--debug", type=int, metavar="N", help="show N train images instead of writing them")
+    args = parser.parse_args()
+
+    if args.debug:
+        pool = load_pool(args.seed, args.cards)
+
+        for index in range(1, args.debug + 1):
+            make_image(*paths(args.out, "train", index), seeded(args.seed, "train", index), pool, debug=True)
+
+    else:
+        splits = {"train": args.train, "val": args.val}
+        gen_images(args.out, splits, args.seed, args.cards, args.workers, resume=not args.force)
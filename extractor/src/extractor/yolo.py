@@ -1,3 +1,7 @@
+import os
+import threading
+import typing as T
+from itertools import batched
 from pathlib import Path
 
 import cv2
@@ -5,7 +9,206 @@ import numpy as np
 from ultralytics import YOLO
 
 MODEL = Path.home() / ".local/share/third-eye/model.pt"
-model = YOLO(MODEL, task="obb")
+
+# torch runs the .pt weights through ultralytics. onnx and openvino run an
+# export of them, made next to the weights on first use, straight on the
+# runtime with our own pre and post-processing.
+BACKEND = os.environ.get("YOLO_BACKEND", "torch")
+IMGSZ = int(os.environ.get("YOLO_IMGSZ", 640))
+CONF = float(os.environ.get("YOLO_CONF", 0.90))
+BATCH = int(os.environ.get("YOLO_BATCH", 8))  # images per forward pass
+
+# Runtime threads per replica for onnx and openvino, 0 lets the runtime
+# decide. torch shares the embed server's TORCH_THREADS.
+THREADS = int(os.environ.get("YOLO_THREADS", 0))
+
+IOU = 0.7  # ultralytics' default NMS threshold
+MAX_WH = 7680  # ultralytics' per class offset for NMS
+SHRINK = 1.1
+
+type Detections = list[tuple[np.ndarray, float]]  # corners and confidence per box
+
+# Neither ultralytics predictors nor OpenVINO infer requests are thread safe,
+# so every inference thread gets its own replica
+local = threading.local()
+exporting = threading.Lock()
+
+
+def export(backend: str) -> Path:
+    path = MODEL.with_suffix(".onnx") if backend == "onnx" else MODEL.with_name(f"{MODEL.stem}_openvino_model")
+
+    with exporting:
+        # Dynamic axes, so any batch size and input size works
+        if not path.exists() or path.stat().st_mtime < MODEL.stat().st_mtime:
+            YOLO(MODEL, task="obb").export(format=backend, imgsz=IMGSZ, dynamic=True)
+
+    return path
+
+
+def onnx_runner(path: Path) -> T.Callable[[np.ndarray], np.ndarray]:
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = THREADS
+    options.inter_op_num_threads = 1
+
+    session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+    name = session.get_inputs()[0].name
+
+    return lambda batch: session.run(None, {name: batch})[0]  # type: ignore
+
+
+def openvino_runner(path: Path) -> T.Callable[[np.ndarray], np.ndarray]:
+    import openvino as ov
+
+    config: dict = {"PERFORMANCE_HINT": "LATENCY"}
+
+    if THREADS:
+        config["INFERENCE_NUM_THREADS"] = THREADS
+
+    model = ov.Core().compile_model(path / f"{MODEL.stem}.xml", "CPU", config)
+
+    return lambda batch: model(batch)[0]
+
+
+def letterbox(image: cv2.typing.MatLike, size: int) -> tuple[np.ndarray, float, tuple[int, int]]:
+    # Same resize and centered gray padding as ultralytics' LetterBox
+    height, width = image.shape[:2]
+    gain = min(size / height, size / width)
+    resized = (round(width * gain), round(height * gain))
+
+    if resized != (width, height):
+        image = cv2.resize(image, resized, interpolation=cv2.INTER_LINEAR)
+
+    dw, dh = (size - resized[0]) / 2, (size - resized[1]) / 2
+    top, bottom = round(dh - 0.1), round(dh + 0.1)
+    left, right = round(dw - 0.1), round(dw + 0.1)
+
+    padded = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+
+    return np.asarray(padded), gain, (left, top)
+
+
+def covariance(boxes: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    a, b = boxes[:, 2] ** 2 / 12, boxes[:, 3] ** 2 / 12
+    cos, sin = np.cos(boxes[:, 4]), np.sin(boxes[:, 4])
+
+    return a * cos**2 + b * sin**2, a * sin**2 + b * cos**2, (a - b) * cos * sin
+
+
+def probiou(boxes: np.ndarray, eps: float = 1e-7) -> np.ndarray:
+    # Pairwise IoU of rotated boxes as gaussians, what ultralytics' rotated NMS uses
+    x, y = boxes[:, 0], boxes[:, 1]
+    a, b, c = covariance(boxes)
+
+    x1, x2 = x[:, None], x[None]
+    y1, y2 = y[:, None], y[None]
+    a1, a2 = a[:, None], a[None]
+    b1, b2 = b[:, None], b[None]
+    c1, c2 = c[:, None], c[None]
+
+    denominator = (a1 + a2) * (b1 + b2) - (c1 + c2) ** 2 + eps
+    t1 = ((a1 + a2) * (y1 - y2) ** 2 + (b1 + b2) * (x1 - x2) ** 2) / denominator * 0.25
+    t2 = ((c1 + c2) * (x2 - x1) * (y1 - y2)) / denominator * 0.5
+    t3 = np.log(
+        ((a1 + a2) * (b1 + b2) - (c1 + c2) ** 2)
+        / (4 * np.sqrt(np.clip(a1 * b1 - c1**2, 0, None) * np.clip(a2 * b2 - c2**2, 0, None)) + eps)
+        + eps
+    )
+    t3 = t3 * 0.5
+
+    distance = np.clip(t1 + t2 + t3, eps, 100)
+    return 1 - np.sqrt(1 - np.exp(-distance) + eps)
+
+
+def corners(boxes: np.ndarray) -> np.ndarray:
+    center, w, h, angle = boxes[:, None, :2], boxes[:, 2:3], boxes[:, 3:4], boxes[:, 4:5]
+    cos, sin = np.cos(angle), np.sin(angle)
+
+    along = np.concatenate([w / 2 * cos, w / 2 * sin], axis=1)[:, None]
+    across = np.concatenate([-h / 2 * sin, h / 2 * cos], axis=1)[:, None]
+
+    return np.concatenate(
+        [center + along + across, center + along - across, center - along - across, center - along + across],
+        axis=1,
+    )
+
+
+def decode(prediction: np.ndarray, gain: float, pad: tuple[int, int]) -> Detections:
+    # One image of the raw OBB head: x, y, w, h, class scores..., angle per anchor
+    prediction = prediction.T
+    scores = prediction[:, 4:-1]
+
+    conf = scores.max(axis=1)
+    keep = conf > CONF
+
+    boxes = np.concatenate([prediction[keep, :4], prediction[keep, -1:]], axis=1).astype(np.float64)
+    classes = scores[keep].argmax(axis=1)
+    conf = conf[keep]
+
+    order = np.argsort(-conf, kind="stable")
+    boxes, classes, conf = boxes[order], classes[order], conf[order]
+
+    # Fast NMS like ultralytics: drop a box overlapping any higher scored one
+    offset = boxes.copy()
+    offset[:, :2] += classes[:, None] * MAX_WH
+
+    if len(boxes):
+        overlaps = np.triu(probiou(offset), k=1)
+        picked = overlaps.max(axis=0) < IOU
+        boxes, conf = boxes[picked], conf[picked]
+
+    # Long side as width, angle in [0, pi)
+    swap = boxes[:, 2] <= boxes[:, 3]
+    boxes[swap, 2], boxes[swap, 3] = boxes[swap, 3], boxes[swap, 2].copy()
+    boxes[:, 4] = (boxes[:, 4] + swap * np.pi / 2) % np.pi
+
+    # Back to the original image
+    boxes[:, 0] -= pad[0]
+    boxes[:, 1] -= pad[1]
+    boxes[:, :4] /= gain
+
+    return list(zip(corners(boxes).astype(np.float32), conf.tolist()))
+
+
+class TorchDetector:
+    def __init__(self):
+        self.model = YOLO(MODEL, task="obb")
+
+    def __call__(self, images: list[cv2.typing.MatLike]) -> list[Detections]:
+        results = self.model.predict(images, imgsz=IMGSZ, conf=CONF, iou=IOU, verbose=False)
+
+        return [
+            list(zip(result.obb.xyxyxyxy.cpu().numpy(), result.obb.conf.cpu().numpy().tolist()))  # type: ignore
+            for result in results
+        ]
+
+
+class RuntimeDetector:
+    def __init__(self, backend: str):
+        runner = onnx_runner if backend == "onnx" else openvino_runner
+        self.run = runner(export(backend))
+
+    def __call__(self, images: list[cv2.typing.MatLike]) -> list[Detections]:
+        boxed = [letterbox(image, IMGSZ) for image in images]
+
+        # BGR HWC uint8 -> RGB CHW float in [0, 1]
+        batch = np.stack([padded for padded, _, _ in boxed])[..., ::-1].transpose(0, 3, 1, 2)
+        batch = np.ascontiguousarray(batch, dtype=np.float32) / 255
+
+        output = self.run(batch)
+
+        return [decode(prediction, gain, pad) for prediction, (_, gain, pad) in zip(output, boxed)]
+
+
+def get_detector(backend: str = BACKEND) -> T.Callable[[list[cv2.typing.MatLike]], list[Detections]]:
+    if not hasattr(local, "detectors"):
+        local.detectors = {}
+
+    if backend not in local.detectors:
+        local.detectors[backend] = TorchDetector() if backend == "torch" else RuntimeDetector(backend)
+
+    return local.detectors[backend]
 
 
 def order_points(pts):
@@ -22,39 +225,55 @@ def order_points(pts):
     return rect
 
 
+def find_card_obboxes_batch(images: list[cv2.typing.MatLike], backend: str = BACKEND) -> list[list[np.ndarray]]:
+    found: list[list[np.ndarray]] = []
+
+    for batch in batched(images, BATCH):
+        for detections in get_detector(backend)(list(batch)):
+            boxes: list[np.ndarray] = []
+
+            for points, _ in detections:
+                points = order_points(points)
+                center = points.mean(axis=0)
+                points = (points - center) / SHRINK + center
+
+                boxes.append(points)
+
+            found.append(boxes)
+
+    return found
+
+
+def find_card_obboxes(image: cv2.typing.MatLike) -> list[np.ndarray]:
+    [boxes] = find_card_obboxes_batch([image])
+    return boxes
+
+
+def warp_card(image: cv2.typing.MatLike, points: np.ndarray) -> cv2.typing.MatLike:
+    dst = np.array(
+        [
+            [0, 0],
+            [488 - 1, 0],
+            [488 - 1, 680 - 1],
+            [0, 680 - 1],
+        ],
+        dtype=np.float32,
+    )
+
+    M = cv2.getPerspectiveTransform(np.asarray(points, dtype=np.float32), dst)
+    return cv2.warpPerspective(image, M, (488, 680))
+
+
 def crop_card_obbox(image: cv2.typing.MatLike, debug=False):
-    # image = preprocess(image)
     crops: list[cv2.typing.MatLike] = []
 
-    for result in model.predict(image):
-        for points, conf in zip(
-            result.obb.xyxyxyxy.cpu().numpy(),  # type: ignore
-            result.obb.conf.cpu().numpy(),  # type: ignore
-        ):
-            if conf < 0.90:
-                continue
-
-            points = order_points(points)
-            center = points.mean(axis=0)
-            points = (points - center) / 1.1 + center
-
-            dst = np.array(
-                [
-                    [0, 0],
-                    [488 - 1, 0],
-                    [488 - 1, 680 - 1],
-                    [0, 680 - 1],
-                ],
-                dtype=np.float32,
-            )
-
-            M = cv2.getPerspectiveTransform(points, dst)
-            warped = cv2.warpPerspective(image, M, (488, 680))
-
-            if debug:
-                cv2.imshow("Cropped", warped)
-                cv2.waitKey(0)
-
-            crops.append(warped)
+    for points in find_card_obboxes(image):
+        warped = warp_card(image, points)
+
+        if debug:
+            cv2.imshow("Cropped", warped)
+            cv2.waitKey(0)
+
+        crops.append(warped)
 
     return crops
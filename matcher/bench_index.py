@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import time
+
+import faiss
+import numpy as np
+from matcher.index import INDEX_TYPES, TRAIN_SIZE, configure, load_index, new_index
+
+K = 9
+
+# index type, search params
+CONFIGS = [
+    ("flat", ""),
+    ("ivf", "nprobe=8"),
+    ("ivf", "nprobe=32"),
+    ("hnsw", "efSearch=32"),
+    ("hnsw", "efSearch=128"),
+    ("ivfpq", "nprobe=16"),
+    ("ivfpq", "nprobe=64"),
+]
+
+
+def rss() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def make_queries(vectors: np.ndarray, n: int, noise: float, seed: int) -> np.ndarray:
+    # Stand-in for photo crops: references with gaussian noise on top
+    rng = np.random.default_rng(seed)
+    picks = vectors[rng.choice(len(vectors), n, replace=False)]
+    jitter = rng.normal(scale=noise * vectors.std(axis=0), size=picks.shape)
+
+    return (picks + jitter).astype(np.float32)
+
+
+def recall(found: np.ndarray, truth: np.ndarray, k: int) -> float:
+    hits = [len(set(f[:k]) & set(t[:k])) for f, t in zip(found, truth)]
+    return sum(hits) / (k * len(truth))
+
+
+def bench(kind: str, params: str, vectors: np.ndarray, queries: np.ndarray, truth: np.ndarray) -> dict:
+    before = rss()
+    start = time.perf_counter()
+
+    index = new_index(kind)
+
+    if not index.is_trained:
+        sample = np.random.default_rng(0).choice(len(vectors), min(TRAIN_SIZE, len(vectors)), replace=False)
+        index.train(vectors[sample])  # type: ignore
+
+    index.add(vectors)  # type: ignore
+    build = time.perf_counter() - start
+
+    configure(index, params)
+
+    # One crop at a time, like /similar-from-image with a single card
+    latencies = []
+
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query[None], K)  # type: ignore
+        latencies.append(time.perf_counter() - start)
+
+    _, found = index.search(queries, K)  # type: ignore
+
+    latencies = np.array(latencies) * 1000
+
+    return {
+        "index": kind,
+        "factory": INDEX_TYPES[kind],
+        "params": params,
+        "build_s": round(build, 2),
+        "recall@1": round(float((found[:, 0] == truth[:, 0]).mean()), 4),
+        "recall@9": round(recall(found, truth, K), 4),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        "index_mb": round(faiss.serialize_index(index).nbytes / 2**20, 1),
+        "rss_mb": round((rss() - before) / 2**20, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall, latency and memory of ANN indexes against flat search")
+    parser.add_argument("--queries", help="optional .npy of real crop embeddings to use as queries")
+    parser.add_argument("-n", type=int, default=1000, help="number of synthetic queries")
+    parser.add_argument("--noise", type=float, default=0.25, help="synthetic query noise, relative to per-dim std")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    # Reference vectors come from the existing index, so nothing is re-embedded
+    index, _ = load_index()
+
+    if ivf := faiss.try_extract_index_ivf(index):
+        ivf.make_direct_map()
+
+    vectors = index.reconstruct_n(0, index.ntotal)
+    del index
+
+    if args.queries:
+        queries = np.load(args.queries).astype(np.float32)
+    else:
+        queries = make_queries(vectors, args.n, args.noise, seed=0)
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)  # type: ignore
+    _, truth = exact.search(queries, K)  # type: ignore
+    del exact
+
+    for kind, params in CONFIGS:
+        result = bench(kind, params, vectors, queries, truth)
+
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print("  ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,32 @@
 import asyncio
-import json
+from pathlib import Path
 
-import faiss
-from matcher.index import get_embeddings
-from matcher.paths import CARDS, IDS, INDEX
-from matcher.yolo import get_bboxes
+from matcher.cards import CardStore, ensure_card_store
+from matcher.client import EmbedClient
+from matcher.index import SearchIndex
+from matcher.yolo import detect_and_embed
 
 
-def run_with_debug(img: str):
-    index = faiss.read_index(str(INDEX))
-    ids = IDS.read_text().splitlines()
+async def embed_with_debug(img: str):
+    async with EmbedClient() as client:
+        # Crops never touch disk, they come back as embeddings with their boxes
+        _, embeddings = await detect_and_embed(client, [Path(img)])
+        return embeddings
 
-    cards = json.loads(CARDS.read_bytes())
-    cards = {card["id"]: card for card in cards}
 
-    images = asyncio.run(get_bboxes(img), debug=True)
-    embeddings = asyncio.run(get_embeddings(images))
-    scores, indices = index.search(embeddings, k=6)  # type: ignore
+def run_with_debug(img: str):
+    index = SearchIndex.open()
 
-    for scores, matches in zip(scores, indices):
-        score = scores[0]
-        match = matches[0]
+    ensure_card_store()
+    cards = CardStore()
 
-        # handle multifaced ids: _1 or _2 suffix
-        id = ids[match]
-        if id[-2] == "_":
-            id = id[:-2]
+    embeddings = asyncio.run(embed_with_debug(img), debug=True)
+    scores, ids = index.search(embeddings, k=6)
 
-        card = cards[id]
+    for score, id in zip(scores[:, 0], ids[:, 0]):
+        card = cards.get(id)
 
-        print(score, card["scryfall_uri"])
+        print(score, card["link"] if card else id)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,190 @@
+import json
+import sqlite3
+from itertools import batched
+
+from .paths import CARD_STORE, CARDS
+
+# Bump when the projected columns change so stores get re-ingested
+STORE_VERSION = 2
+
+COLUMNS = ("id", "name", "link", "set", "set_name", "image", "price", "edhrec", "lang")
+
+
+def extract_image_uri(card: dict) -> str:
+    if uris := card.get("image_uris"):
+        return uris.get("normal", None)
+
+    return card.get("card_faces", [])[0].get("image_uris", {}).get("normal", None)
+
+
+def usd_to_eur(price: str) -> str:
+    return str(float(price) * 0.86)
+
+
+def extract_price(card: dict) -> str:
+    foil = card["foil"]
+    nonfoil = card["nonfoil"]
+    prices = card["prices"]
+
+    if foil and not nonfoil:
+        if price := prices["eur_foil"]:
+            return price
+
+        if price := prices["usd_foil"]:
+            return usd_to_eur(price)
+
+    if price := prices["eur"]:
+        return price
+
+    if price := prices["usd"]:
+        return usd_to_eur(price)
+
+    return "0.00"
+
+
+def project(card: dict) -> tuple:
+    return (
+        card["id"],
+        card["name"],
+        card["scryfall_uri"],
+        card["set"],
+        card["set_name"],
+        extract_image_uri(card),
+        extract_price(card),
+        card.get("edhrec_rank", 0),
+        card.get("lang", "en"),
+    )
+
+
+def source() -> str:
+    stat = CARDS.stat()
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def is_usable() -> bool:
+    # Possibly from older bulk data, but laid out the way CardStore expects
+    if not CARD_STORE.exists():
+        return False
+
+    with sqlite3.connect(f"file:{CARD_STORE}?mode=ro", uri=True) as conn:
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+
+    conn.close()
+    return version == STORE_VERSION
+
+
+def is_current() -> bool:
+    if not is_usable():
+        return False
+
+    with sqlite3.connect(f"file:{CARD_STORE}?mode=ro", uri=True) as conn:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+
+    conn.close()
+    return row is not None and row[0] == source()
+
+
+def ingest():
+    # The only place the full Scryfall JSON gets parsed, once per bulk update
+    cards = json.loads(CARDS.read_bytes())
+
+    tmp = CARD_STORE.with_name(f"{CARD_STORE.name}.tmp")
+    tmp.unlink(missing_ok=True)
+
+    with sqlite3.connect(tmp) as conn:
+        conn.execute(
+            """
+            CREATE TABLE cards (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                link TEXT NOT NULL,
+                "set" TEXT NOT NULL,
+                set_name TEXT NOT NULL,
+                image TEXT,
+                price TEXT NOT NULL,
+                edhrec INTEGER,
+                lang TEXT NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+
+        # For restricted searches, see CardStore.ids_where
+        conn.execute('CREATE INDEX cards_set ON cards ("set", lang)')
+
+        conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+        conn.executemany("INSERT INTO cards VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", map(project, cards))
+        conn.execute("INSERT INTO meta VALUES ('source', ?)", (source(),))
+        conn.execute(f"PRAGMA user_version = {STORE_VERSION}")
+
+    conn.close()
+    tmp.replace(CARD_STORE)
+
+
+def card_ids() -> set[str]:
+    with sqlite3.connect(f"file:{CARD_STORE}?mode=ro", uri=True) as conn:
+        ids = {id for (id,) in conn.execute("SELECT id FROM cards")}
+
+    conn.close()
+    return ids
+
+
+def ensure_card_store() -> bool:
+    """Re-ingest cards.json if it changed, returns whether it did."""
+    if is_current():
+        return False
+
+    ingest()
+    return True
+
+
+class CardStore:
+    def __init__(self):
+        # Read only and shared by every request, lookups are primary key hits
+        self.conn = sqlite3.connect(f"file:{CARD_STORE}?mode=ro", uri=True, check_same_thread=False)
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, id: str) -> dict | None:
+        row = self.conn.execute("SELECT * FROM cards WHERE id = ?", (id,)).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def by_ids(self, ids: list[str]) -> list[dict]:
+        found: dict[str, dict] = {}
+
+        # Stay below SQLite's bound parameter limit
+        for chunk in batched(set(ids), 900):
+            placeholders = ", ".join("?" * len(chunk))
+            rows = self.conn.execute(f"SELECT * FROM cards WHERE id IN ({placeholders})", chunk)
+            found.update((row[0], dict(zip(COLUMNS, row))) for row in rows)
+
+        # Same order as asked, duplicates included
+        return [found[id] for id in ids if id in found]
+
+    def sets(self, ids: list[str]) -> list[str]:
+        found: set[str] = set()
+
+        for chunk in batched(set(ids), 900):
+            placeholders = ", ".join("?" * len(chunk))
+            found.update(
+                set for (set,) in self.conn.execute(f'SELECT "set" FROM cards WHERE id IN ({placeholders})', chunk)
+            )
+
+        return sorted(found)
+
+    def ids_where(self, sets: list[str], lang: str | None) -> list[str]:
+        # Empty sets or no lang means no constraint on that column
+        clauses = []
+        params: list[str] = []
+
+        if sets:
+            clauses.append(f'"set" IN ({", ".join("?" * len(sets))})')
+            params += sets
+
+        if lang:
+            clauses.append("lang = ?")
+            params.append(lang)
+
+        where = " AND ".join(clauses) or "1"
+        return [id for (id,) in self.conn.execute(f"SELECT id FROM cards WHERE {where}", params)]
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import random
+
+import httpx
+
+from telemetry import merge, parse_server_timing, timed
+
+EMBED_URL = os.environ.get("EMBED_URL", "http://localhost:8000")
+
+# Unix socket of a co-located embed server, e.g. `uvicorn --uds /run/third-eye/embed.sock`
+EMBED_UDS = os.environ.get("EMBED_UDS")
+
+MAX_CONCURRENCY = int(os.environ.get("EMBED_MAX_CONCURRENCY", 16))
+RETRIES = 3
+BACKOFF = 0.25  # seconds, doubled every attempt
+
+TIMEOUT = httpx.Timeout(60, connect=5)
+
+# Worth another try: the server is restarting or a kept-alive connection went stale
+TRANSIENT_STATUS = {502, 503, 504}
+TRANSIENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError, httpx.ReadError)
+
+
+class EmbedClient:
+    def __init__(
+        self,
+        url: str = EMBED_URL,
+        uds: str | None = EMBED_UDS,
+        concurrency: int = MAX_CONCURRENCY,
+        retries: int = RETRIES,
+    ):
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        transport = httpx.AsyncHTTPTransport(uds=uds, limits=limits)
+
+        self.client = httpx.AsyncClient(base_url=url, transport=transport, timeout=TIMEOUT)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.retries = retries
+
+    async def __aenter__(self) -> "EmbedClient":
+        return self
+
+    async def __aexit__(self, *_):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def get(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", path, **kwargs)
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        # Every embed server endpoint is a pure function of its input, so
+        # retrying a POST is safe
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+
+            try:
+                async with self.semaphore:
+                    with timed("embed"):
+                        response = await self.client.request(method, path, **kwargs)
+
+                if response.status_code not in TRANSIENT_STATUS or last:
+                    # The embed server's own stages show up in our Server-Timing
+                    merge(parse_server_timing(response.headers.get("server-timing", "")), "embed-")
+
+                    response.raise_for_status()
+                    return response
+
+            except TRANSIENT_ERRORS:
+                if last:
+                    raise
+
+            await asyncio.sleep(BACKOFF * 2**attempt * random.uniform(0.5, 1.5))
+
+        raise AssertionError("unreachable")
@@ -0,0 +1,128 @@
+import os
+import re
+import time
+from collections import OrderedDict
+from pathlib import Path
+from uuid import uuid4
+
+from telemetry import registry
+
+from .paths import CROPS
+
+MAX_BYTES = int(os.environ.get("CROP_CACHE_MB", 512)) * 1024 * 1024
+MAX_AGE = float(os.environ.get("CROP_CACHE_MAX_AGE_HOURS", 24 * 7)) * 3600
+
+# {object_id}_{box}.jpg, the object and box index a crop is warped from. Ids
+# are content hashes, or uuid4s for objects stored before those.
+NAME = re.compile(r"([0-9a-f]{64}|[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12})_(\d+)\.jpg")
+
+evictions = registry.counter("crop_cache_evictions_total", "Crops evicted by reason")
+
+
+def crop_name(object_id: str, box: int) -> str:
+    return f"{object_id}_{box}.jpg"
+
+
+def parse_crop_name(name: str) -> tuple[str, int] | None:
+    if not (match := NAME.fullmatch(name)):
+        return None
+
+    return match[1], int(match[2])
+
+
+class CropCache:
+    # Warped crops on disk, least recently used evicted first once over the
+    # size budget or past the age limit. Anything evicted is warped again
+    # from its object and persisted box on the next request.
+    def __init__(self, root: Path = CROPS, max_bytes: int = MAX_BYTES, max_age: float = MAX_AGE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        # Name -> (size, last used), oldest first
+        self.entries: OrderedDict[str, tuple[int, float]] = OrderedDict()
+        self.bytes = 0
+
+        registry.gauge("crop_cache_bytes", "Size of the crops on disk", lambda: self.bytes)
+        registry.gauge("crop_cache_files", "Crops on disk", lambda: len(self.entries))
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        # Modification times double as last use, hits touch the file, so the
+        # LRU order survives restarts
+        found = []
+
+        for path in self.root.iterdir():
+            if path.suffix != ".jpg":
+                path.unlink(missing_ok=True)  # left over from an interrupted write
+                continue
+
+            stat = path.stat()
+            found.append((stat.st_mtime, path.name, stat.st_size))
+
+        for used, name, size in sorted(found):
+            self.entries[name] = (size, used)
+            self.bytes += size
+
+        self.evict()
+
+    def get(self, name: str) -> Path | None:
+        self.evict()
+
+        if (entry := self.entries.get(name)) is None:
+            return None
+
+        path = self.root / name
+        now = time.time()
+
+        try:
+            os.utime(path, (now, now))
+        except FileNotFoundError:
+            self.remove(name)
+            return None
+
+        self.entries[name] = (entry[0], now)
+        self.entries.move_to_end(name)
+
+        return path
+
+    def put(self, name: str, data: bytes) -> Path:
+        path = self.root / name
+        tmp = path.with_name(f"{name}.{uuid4().hex}.tmp")
+        tmp.write_bytes(data)
+        tmp.replace(path)
+
+        if name in self.entries:
+            self.bytes -= self.entries[name][0]
+
+        self.entries[name] = (len(data), time.time())
+        self.entries.move_to_end(name)
+        self.bytes += len(data)
+
+        self.evict()
+
+        return path
+
+    def remove(self, name: str):
+        size, _ = self.entries.pop(name)
+        self.bytes -= size
+
+        (self.root / name).unlink(missing_ok=True)
+
+    def evict(self):
+        expired = time.time() - self.max_age
+
+        while self.entries:
+            name, (_, used) = next(iter(self.entries.items()))
+
+            if used < expired:
+                reason = "age"
+            elif self.bytes > self.max_bytes:
+                reason = "size"
+            else:
+                break
+
+            self.remove(name)
+            evictions.inc(reason=reason)
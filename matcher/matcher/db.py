@@ -1,35 +1,252 @@
+import asyncio
+import os
+import queue
 import sqlite3
+import threading
+import time
+import typing as T
+from itertools import batched
+
+from telemetry import SIZES, registry, timed
 
 from .paths import DB
 
+READERS = int(os.environ.get("DB_READERS", 4))
+MAX_GROUP = 256  # writes committed in one transaction at most
 
-def init_db():
-    with sqlite3.connect(DB) as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS matches (
-                id INTEGER PRIMARY KEY,
-                card_id TEXT NOT NULL,
-                source TEXT NOT NULL,
-                session TEXT NOT NULL
-            )
-            """
-        )
+write_group = registry.histogram("db_write_group_size", "Writes committed per transaction", SIZES)
+commit_seconds = registry.histogram("db_commit_seconds", "Time per write transaction, fsync included")
 
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS queue (
-                id INTEGER PRIMARY KEY,
-                object_id TEXT NOT NULL,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-            """
-        )
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+)
+
+# Applied in order, PRAGMA user_version counts how many already ran
+MIGRATIONS = (
+    """
+    CREATE TABLE IF NOT EXISTS matches (
+        id INTEGER PRIMARY KEY,
+        card_id TEXT NOT NULL,
+        source TEXT NOT NULL,
+        session TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS queue (
+        id INTEGER PRIMARY KEY,
+        object_id TEXT NOT NULL,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+    """
+    CREATE INDEX matches_session ON matches (session);
+    CREATE INDEX matches_card_id ON matches (card_id);
+    CREATE INDEX queue_created_at ON queue (created_at);
+
+    -- Latest match per session, kept up to date by a trigger so listing
+    -- sessions doesn't have to group the whole matches table
+    CREATE TABLE sessions (
+        session TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL
+    );
+
+    CREATE INDEX sessions_last_id ON sessions (last_id);
+
+    INSERT INTO sessions (session, last_id)
+    SELECT session, MAX(id) FROM matches GROUP BY session;
+
+    CREATE TRIGGER matches_sessions AFTER INSERT ON matches
+    BEGIN
+        INSERT INTO sessions (session, last_id) VALUES (NEW.session, NEW.id)
+        ON CONFLICT (session) DO UPDATE SET last_id = MAX(last_id, excluded.last_id);
+    END;
+    """,
+    """
+    -- pending -> processing -> done | failed, see worker.py
+    ALTER TABLE queue ADD COLUMN status TEXT NOT NULL DEFAULT 'pending';
+    ALTER TABLE queue ADD COLUMN error TEXT;
+
+    CREATE INDEX queue_status ON queue (status, id);
+
+    -- Recognition output per object, served as is by /similar-from-image
+    CREATE TABLE results (
+        object_id TEXT PRIMARY KEY,
+        boxes TEXT NOT NULL,
+        candidates TEXT NOT NULL,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+    """
+    -- Objects are content addressed now, so results are reusable across
+    -- uploads: detections and embeddings hold while the models do, search
+    -- candidates while the index does
+    DROP TABLE results;
+
+    CREATE TABLE results (
+        object_id TEXT PRIMARY KEY,
+        model TEXT NOT NULL,
+        index_version TEXT NOT NULL,
+        boxes TEXT NOT NULL,
+        embeddings BLOB NOT NULL,
+        candidates TEXT NOT NULL,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+)
+
+
+def connect() -> sqlite3.Connection:
+    # Autocommit mode, transactions are managed explicitly by the writer
+    conn = sqlite3.connect(DB, isolation_level=None, check_same_thread=False)
+
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+
+    return conn
+
+
+def migrate(conn: sqlite3.Connection):
+    (version,) = conn.execute("PRAGMA user_version").fetchone()
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.executescript(f"BEGIN IMMEDIATE; {migration}; PRAGMA user_version = {number}; COMMIT;")
+
+
+type Job = tuple[T.Callable, tuple, asyncio.Future, asyncio.AbstractEventLoop]
+
+
+def resolve(future: asyncio.Future, result: object, error: BaseException | None):
+    if future.done():
+        return
+
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class Database:
+    def __init__(self, readers: int = READERS):
+        writer = connect()
+        migrate(writer)
+
+        self.readers: queue.SimpleQueue[sqlite3.Connection] = queue.SimpleQueue()
+
+        for _ in range(readers):
+            self.readers.put(connect())
+
+        self.writes: queue.SimpleQueue[Job | None] = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.write_loop, args=(writer,), name="db-writer", daemon=True)
+        self.writer.start()
+
+    def close(self):
+        self.writes.put(None)
+        self.writer.join()
+
+        while not self.readers.empty():
+            self.readers.get().close()
+
+    async def read[R](self, fn: T.Callable[..., R], *args) -> R:
+        def run() -> R:
+            conn = self.readers.get()
+
+            try:
+                return fn(conn, *args)
+            finally:
+                self.readers.put(conn)
+
+        with timed("sqlite"):
+            return await asyncio.to_thread(run)
+
+    async def write[R](self, fn: T.Callable[..., R], *args) -> R:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        self.writes.put((fn, args, future, loop))
+
+        with timed("sqlite"):
+            return await future
+
+    def write_loop(self, conn: sqlite3.Connection):
+        while (job := self.writes.get()) is not None:
+            jobs = [job]
+            stop = False
+
+            # Group commit: whatever queued up during the last commit goes
+            # into the same transaction and shares its fsync
+            while len(jobs) < MAX_GROUP:
+                try:
+                    job = self.writes.get_nowait()
+                except queue.Empty:
+                    break
+
+                if job is None:
+                    stop = True
+                    break
+
+                jobs.append(job)
+
+            self.commit(conn, jobs)
+
+            if stop:
+                break
+
+        conn.close()
+
+    def commit(self, conn: sqlite3.Connection, jobs: list[Job]):
+        results: list[tuple[object, BaseException | None]] = []
+        start = time.perf_counter()
+
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+
+            # A savepoint per job, so one failing write doesn't sink the rest
+            for fn, args, _, _ in jobs:
+                conn.execute("SAVEPOINT job")
 
+                try:
+                    results.append((fn(conn, *args), None))
+                    conn.execute("RELEASE job")
+                except Exception as error:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((None, error))
 
-def insert_match(card_id: str, source: str, session: str):
-    with sqlite3.connect(DB) as conn:
-        conn.execute(
+            conn.execute("COMMIT")
+
+        except Exception as error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+
+            results = [(None, error)] * len(jobs)
+
+        write_group.observe(len(jobs))
+        commit_seconds.observe(time.perf_counter() - start)
+
+        for (_, _, future, loop), (result, error) in zip(jobs, results):
+            loop.call_soon_threadsafe(resolve, future, result, error)
+
+
+def insert_match(conn: sqlite3.Connection, card_id: str, source: str, session: str):
+    conn.execute(
+        """
+        INSERT INTO matches (card_id, source, session)
+        VALUES (?, ?, ?)
+        """,
+        (card_id, source, session),
+    )
+
+
+def insert_matches(conn: sqlite3.Connection, matches: list[tuple[str, str, str]]) -> list[int]:
+    ids = []
+
+    for card_id, source, session in matches:
+        cursor = conn.execute(
             """
             INSERT INTO matches (card_id, source, session)
             VALUES (?, ?, ?)
@@ -37,60 +254,143 @@ def insert_match(card_id: str, source: str, session: str):
             (card_id, source, session),
         )
 
+        ids.append(cursor.lastrowid)
 
-def get_session(session_id: str):
-    with sqlite3.connect(DB) as conn:
-        cursor = conn.execute(
-            """
-            SELECT * FROM matches WHERE session = ?
-            """,
-            (session_id,),
-        )
+    return ids
 
-        return cursor.fetchall()
 
+def get_session(conn: sqlite3.Connection, session_id: str):
+    cursor = conn.execute(
+        """
+        SELECT * FROM matches WHERE session = ?
+        """,
+        (session_id,),
+    )
 
-def list_sessions():
-    with sqlite3.connect(DB) as conn:
-        cursor = conn.execute(
-            """
-            SELECT session
-            FROM matches
-            GROUP BY session
-            ORDER BY MAX(id) DESC;
-            """
-        )
+    return cursor.fetchall()
 
-        return cursor.fetchall()
 
+def session_card_ids(conn: sqlite3.Connection, session_id: str) -> list[str]:
+    return [card_id for (card_id,) in conn.execute("SELECT card_id FROM matches WHERE session = ?", (session_id,))]
 
-def list_collection():
-    with sqlite3.connect(DB) as conn:
-        cursor = conn.execute(
-            """
-            SELECT card_id
-            FROM matches
-            """
-        )
 
-        return cursor.fetchall()
+def list_sessions(conn: sqlite3.Connection):
+    cursor = conn.execute(
+        """
+        SELECT session
+        FROM sessions
+        ORDER BY last_id DESC;
+        """
+    )
 
+    return cursor.fetchall()
+
+
+def list_collection(conn: sqlite3.Connection):
+    cursor = conn.execute(
+        """
+        SELECT card_id
+        FROM matches
+        """
+    )
+
+    return cursor.fetchall()
 
-def queue_image(object_id: str):
-    with sqlite3.connect(DB) as conn:
-        conn.execute(
-            "INSERT INTO queue (object_id) VALUES (?)",
-            (object_id,),
-        )
 
+def queue_image(conn: sqlite3.Connection, object_id: str):
+    conn.execute(
+        "INSERT INTO queue (object_id) VALUES (?)",
+        (object_id,),
+    )
 
-def list_queue():
-    with sqlite3.connect(DB) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.execute("SELECT id, object_id, created_at FROM queue ORDER BY created_at")
-        return [dict(row) for row in cursor.fetchall()]
 
+def queue_images(conn: sqlite3.Connection, object_ids: list[str]) -> list[int]:
+    return [
+        conn.execute("INSERT INTO queue (object_id) VALUES (?)", (object_id,)).lastrowid  # type: ignore
+        for object_id in object_ids
+    ]
+
+
+def list_queue(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    cursor.execute("SELECT id, object_id, created_at, status, error FROM queue ORDER BY created_at")
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def dequeue_image(conn: sqlite3.Connection, id: int):
+    conn.execute("DELETE FROM queue WHERE id = ?", (id,))
+
+
+def dequeue_images(conn: sqlite3.Connection, ids: list[int]) -> list[bool]:
+    return [conn.execute("DELETE FROM queue WHERE id = ?", (id,)).rowcount > 0 for id in ids]
+
+
+def count_queued(conn: sqlite3.Connection) -> dict[str, int]:
+    return dict(conn.execute("SELECT status, COUNT(*) FROM queue GROUP BY status").fetchall())
+
+
+def reset_processing(conn: sqlite3.Connection):
+    # Whatever was being worked on when the server stopped gets another go
+    conn.execute("UPDATE queue SET status = 'pending' WHERE status = 'processing'")
+
+
+def claim_queued(conn: sqlite3.Connection, limit: int) -> list[tuple[int, str]]:
+    cursor = conn.execute(
+        """
+        UPDATE queue SET status = 'processing'
+        WHERE id IN (SELECT id FROM queue WHERE status = 'pending' ORDER BY id LIMIT ?)
+        RETURNING id, object_id
+        """,
+        (limit,),
+    )
+
+    return cursor.fetchall()
+
+
+def save_results(conn: sqlite3.Connection, results: list[tuple[str, str, str, str, bytes, str]]):
+    conn.executemany(
+        """
+        INSERT INTO results (object_id, model, index_version, boxes, embeddings, candidates)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (object_id) DO UPDATE SET
+            model = excluded.model,
+            index_version = excluded.index_version,
+            boxes = excluded.boxes,
+            embeddings = excluded.embeddings,
+            candidates = excluded.candidates,
+            created_at = CURRENT_TIMESTAMP
+        """,
+        results,
+    )
+
+
+def finish_queued(conn: sqlite3.Connection, done: list[int], failed: list[tuple[int, str]]):
+    conn.executemany("UPDATE queue SET status = 'done', error = NULL WHERE id = ?", [(id,) for id in done])
+    conn.executemany(
+        "UPDATE queue SET status = 'failed', error = ? WHERE id = ?", [(error, id) for id, error in failed]
+    )
+
+
+def get_boxes(conn: sqlite3.Connection, object_id: str) -> str | None:
+    row = conn.execute("SELECT boxes FROM results WHERE object_id = ?", (object_id,)).fetchone()
+    return row[0] if row else None
+
+
+def get_results(conn: sqlite3.Connection, object_ids: list[str], model: str) -> dict[str, tuple[str, str, bytes, str]]:
+    found = {}
+
+    # Stay below SQLite's bound parameter limit
+    for chunk in batched(set(object_ids), 900):
+        placeholders = ", ".join("?" * len(chunk))
+        rows = conn.execute(
+            f"""
+            SELECT object_id, index_version, boxes, embeddings, candidates FROM results
+            WHERE model = ? AND object_id IN ({placeholders})
+            """,
+            (model, *chunk),
+        )
+
+        found.update((object_id, tuple(row)) for object_id, *row in rows)
 
-def dequeue_image(id: int):
-    with sqlite3.connect(DB) as conn:
-        conn.execute("DELETE FROM queue WHERE id = ?", (id,))
+    return found
@@ -1,39 +1,476 @@
-from itertools import batched
+import asyncio
+import os
+import typing as T
+from pathlib import Path
+from uuid import uuid4
 
 import faiss
 import numpy as np
-from httpx import AsyncClient
+from httpx import Response
 from tqdm import tqdm
 
-from .paths import IDS, IMAGES, INDEX
+from .cards import card_ids
+from .client import EmbedClient
+from .paths import CARD_IDS, COMMIT, ID_TABLE, IDS, IMAGES, INDEX, INDEX_VERSION
 
 BATCH_SIZE = 128
+IN_FLIGHT = 4  # batches being embedded at once
+FLUSH_AFTER = 2  # seconds a partial batch waits for more downloads
+CHECKPOINT_EVERY = 20  # batches at least, see collect
+CHECKPOINT_GROWTH = 0.25  # and at least this fraction of the index
 
+DIMENSIONS = 384  # 768, 1152
 
-async def get_embeddings(paths: list[str]) -> np.typing.NDArray[np.float32]:
-    async with AsyncClient() as client:
-        result = await client.post(
-            "http://localhost:8000/embed",
-            json=paths,
-            timeout=60,
-        )
+# faiss index_factory strings, see matcher/bench_index.py for the tradeoffs
+INDEX_TYPES = {
+    "flat": "Flat",
+    "ivf": "IVF512,Flat",
+    "hnsw": "HNSW32",
+    "ivfpq": "IVF512,PQ48",
+}
 
-    result.raise_for_status()
-    json = result.json()
+INDEX_TYPE = os.environ.get("THIRD_EYE_INDEX", "flat")
+TRAIN_SIZE = 20_000
 
-    return np.array(json, dtype=np.float32)
+# Runtime knobs in faiss ParameterSpace syntax, e.g. "nprobe=16" or "efSearch=64"
+SEARCH_PARAMS = os.environ.get("THIRD_EYE_SEARCH_PARAMS", "")
 
+# Files that make up one index snapshot, always committed together
+SNAPSHOT = (INDEX, IDS, ID_TABLE, CARD_IDS, INDEX_VERSION)
 
-async def create_index():
-    index = faiss.IndexFlatL2(384)  # 768, 1152
+# Per vector: row in CARD_IDS and face number (0 for single faced cards)
+ID_ROW = np.dtype([("card", "<u4"), ("face", "u1")])
 
-    with IDS.open("w") as f:
-        for batch in tqdm(batched(IMAGES.glob("*.jpg"), BATCH_SIZE)):
-            paths = [str(path) for path in batch]
-            embeddings = await get_embeddings(paths)
-            index.add(embeddings)  # type: ignore
 
-            for path in batch:
-                f.write(f"{path.stem}\n")
+# Ask the embed server for raw float32 rows instead of JSON
+BINARY = {"Accept": "application/octet-stream"}
 
-    faiss.write_index(index, str(INDEX))
+
+def read_embeddings(result: Response, offset: int = 0) -> np.typing.NDArray[np.float32]:
+    rows, dims = map(int, result.headers["X-Embedding-Shape"].split(","))
+    return np.frombuffer(result.content, dtype="<f4", offset=offset).reshape(rows, dims)
+
+
+async def get_embeddings(client: EmbedClient, paths: list[str]) -> np.typing.NDArray[np.float32]:
+    result = await client.post("/embed", json=paths, headers=BINARY)
+    return read_embeddings(result)
+
+
+def card_id(id: str) -> str:
+    # handle multifaced ids: _1 or _2 suffix
+    if id[-2] == "_":
+        return id[:-2]
+
+    return id
+
+
+def id_tables(ids: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    rows: dict[str, int] = {}
+    table = np.empty(len(ids), dtype=ID_ROW)
+
+    for i, id in enumerate(ids):
+        card = card_id(id)
+        face = int(id[-1]) if card != id else 0
+        table[i] = (rows.setdefault(card, len(rows)), face)
+
+    return table, np.array(list(rows), dtype="S36")
+
+
+def staged(path: Path) -> Path:
+    return path.with_name(f"{path.name}.tmp")
+
+
+def fsync(path: Path):
+    with path.open("rb") as f:
+        os.fsync(f.fileno())
+
+
+def recover():
+    # A commit marker means every staged file was fully written, so finish the
+    # swap. Without one the staged files are partial and get discarded.
+    if COMMIT.exists():
+        for path in SNAPSHOT:
+            if staged(path).exists():
+                staged(path).replace(path)
+
+        COMMIT.unlink()
+
+    for path in SNAPSHOT:
+        staged(path).unlink(missing_ok=True)
+
+
+def commit(index: faiss.Index, ids: list[str]):
+    assert index.ntotal == len(ids)
+
+    faiss.write_index(index, str(staged(INDEX)))
+    staged(IDS).write_text("".join(f"{id}\n" for id in ids))
+
+    table, cards = id_tables(ids)
+
+    for path, array in ((ID_TABLE, table), (CARD_IDS, cards)):
+        with staged(path).open("wb") as f:
+            np.save(f, array)
+
+    # Fresh for every snapshot, so results cached against the old one go stale
+    staged(INDEX_VERSION).write_text(uuid4().hex)
+
+    for path in SNAPSHOT:
+        fsync(staged(path))
+
+    COMMIT.touch()
+    fsync(COMMIT)
+
+    recover()
+
+
+def checkpoint(index: faiss.Index, ids: list[str]):
+    # An empty or untrained snapshot would be opened and served as ready,
+    # keep the last usable one until there's something to search
+    if index.ntotal and index.is_trained:
+        commit(index, ids)
+
+
+def new_index(kind: str = INDEX_TYPE) -> faiss.Index:
+    return faiss.index_factory(DIMENSIONS, INDEX_TYPES[kind])
+
+
+def configure(index: faiss.Index, params: str = SEARCH_PARAMS) -> faiss.Index:
+    if params:
+        faiss.ParameterSpace().set_index_parameters(index, params)
+
+    return index
+
+
+def without(index: faiss.Index, positions: list[int]) -> faiss.Index:
+    # Flat storage compacts in place and keeps the order of the rest
+    if isinstance(index, faiss.IndexFlat):
+        index.remove_ids(np.array(positions, dtype=np.int64))
+        return index
+
+    # HNSW can't remove and IVF keeps the old labels, which would no longer
+    # line up with ids.txt. Re-add the survivors to an emptied clone instead,
+    # which keeps the trained quantizer.
+    if ivf := faiss.try_extract_index_ivf(index):
+        ivf.make_direct_map()
+
+    keep = np.setdiff1d(np.arange(index.ntotal), positions)
+    vectors = index.reconstruct_batch(keep)
+
+    rebuilt = faiss.clone_index(index)
+    rebuilt.reset()
+
+    if ivf := faiss.try_extract_index_ivf(rebuilt):
+        ivf.make_direct_map(False)
+
+    rebuilt.add(vectors)  # type: ignore
+
+    return rebuilt
+
+
+def is_kind(index: faiss.Index, kind: str = INDEX_TYPE) -> bool:
+    # Same faiss class, metric and list and code counts as the factory string
+    # builds. What read_index returns can be a subclass, "Flat" comes back as
+    # IndexFlatL2, and a flat snapshot must never look converted, or every
+    # start would rewrite it and invalidate every cached result.
+    expected = new_index(kind)
+
+    if not isinstance(index, type(expected)) or index.metric_type != expected.metric_type:
+        return False
+
+    if ivf := faiss.try_extract_index_ivf(expected):
+        if ivf.nlist != faiss.extract_index_ivf(index).nlist:
+            return False
+
+    if isinstance(expected, faiss.IndexIVFPQ):
+        return expected.pq.M == index.pq.M  # type: ignore
+
+    if isinstance(expected, faiss.IndexHNSW):
+        return expected.hnsw.nb_neighbors(0) == index.hnsw.nb_neighbors(0)  # type: ignore
+
+    return True
+
+
+def convert(index: faiss.Index, kind: str = INDEX_TYPE) -> faiss.Index:
+    # Flat storage gives the vectors back exactly, so switching index types
+    # doesn't re-embed anything. Anything lossy starts over empty.
+    converted = new_index(kind)
+    lossless = isinstance(index, faiss.IndexFlat | faiss.IndexIVFFlat | faiss.IndexHNSWFlat)
+
+    if not lossless or (not converted.is_trained and index.ntotal < TRAIN_SIZE):
+        return converted
+
+    if ivf := faiss.try_extract_index_ivf(index):
+        ivf.make_direct_map()
+
+    vectors = index.reconstruct_n(0, index.ntotal)
+
+    if not converted.is_trained:
+        sample = np.random.default_rng(0).permutation(len(vectors))[:TRAIN_SIZE]
+        converted.train(vectors[sample])  # type: ignore
+
+    converted.add(vectors)  # type: ignore
+
+    return converted
+
+
+def load_index() -> tuple[faiss.Index, list[str]]:
+    recover()
+
+    index = faiss.read_index(str(INDEX))
+    ids = IDS.read_text().splitlines()
+
+    return index, ids
+
+
+def search_parameters(index: faiss.Index, selector: faiss.IDSelector) -> faiss.SearchParameters:
+    # Per search parameters replace the index's own, so carry the configured ones over
+    if ivf := faiss.try_extract_index_ivf(index):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+
+    return faiss.SearchParameters(sel=selector)
+
+
+class Restriction(T.NamedTuple):
+    key: str  # what it allows, part of the key cached results are stored under
+    allowed: np.ndarray  # bit per vector, see SearchIndex.restrict
+
+
+def has_snapshot() -> bool:
+    recover()
+    return all(path.exists() for path in SNAPSHOT)
+
+
+class SearchIndex(T.NamedTuple):
+    index: faiss.Index
+    table: np.ndarray
+    cards: np.ndarray
+    version: str
+
+    @classmethod
+    def open(cls) -> "SearchIndex":
+        recover()
+
+        # Vectors and id tables are mapped rather than read, so workers share
+        # the page cache and start without copying anything
+        flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+        index = configure(faiss.read_index(str(INDEX), flags))
+
+        table = np.load(ID_TABLE, mmap_mode="r")
+        cards = np.load(CARD_IDS, mmap_mode="r")
+
+        # Search params change results as much as the vectors do
+        version = f"{INDEX_VERSION.read_text()}:{SEARCH_PARAMS}"
+
+        return cls(index, table, cards, version)
+
+    @property
+    def usable(self) -> bool:
+        return self.index.ntotal > 0 and self.index.is_trained
+
+    def restrict(self, card_ids: list[str], key: str) -> Restriction:
+        rows = np.isin(self.cards, np.array(card_ids, dtype="S36"))
+        return Restriction(key, np.packbits(rows[self.table["card"]], bitorder="little"))
+
+    def search(
+        self,
+        embeddings: np.ndarray,
+        k: int,
+        restriction: Restriction | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        params = None
+
+        # Nothing to find, the id tables are empty too
+        if not self.usable:
+            return np.full((len(embeddings), k), -np.inf, dtype=np.float32), np.full((len(embeddings), k), "")
+
+        # Filtered inside the index, so the top k are all allowed cards and
+        # vectors outside the selection cost next to nothing
+        if restriction is not None:
+            selector = faiss.IDSelectorBitmap(self.index.ntotal, faiss.swig_ptr(restriction.allowed))
+            params = search_parameters(self.index, selector)
+
+        scores, indices = self.index.search(embeddings, k, params=params)  # type: ignore
+
+        ids = self.cards[self.table["card"][indices]].astype(str)
+
+        # Approximate indexes pad with -1 when they find fewer than k
+        ids[indices < 0] = ""
+
+        return scores, ids
+
+
+async def produce(
+    paths: list[Path],
+    downloads: asyncio.Queue[Path | None] | None,
+    indexed: set[str],
+    batches: asyncio.Queue[list[Path] | None],
+):
+    # Images already on disk go first, then whatever lands while downloading
+    batch: list[Path] = []
+
+    async def flush():
+        nonlocal batch
+
+        if batch:
+            await batches.put(batch)
+            batch = []
+
+    async def take(path: Path):
+        if path.stem in indexed:
+            return
+
+        indexed.add(path.stem)
+        batch.append(path)
+
+        if len(batch) == BATCH_SIZE:
+            await flush()
+
+    for path in paths:
+        await take(path)
+
+    while downloads is not None:
+        try:
+            # Don't let a partial batch wait on a slow download forever
+            path = await asyncio.wait_for(downloads.get(), FLUSH_AFTER if batch else None)
+        except TimeoutError:
+            await flush()
+            continue
+
+        if path is None:
+            break
+
+        await take(path)
+
+    await flush()
+
+    for _ in range(IN_FLIGHT):
+        await batches.put(None)
+
+
+async def embed(
+    client: EmbedClient,
+    batches: asyncio.Queue[list[Path] | None],
+    embedded: asyncio.Queue[tuple[list[Path], np.ndarray] | None],
+):
+    while (batch := await batches.get()) is not None:
+        embeddings = await get_embeddings(client, [str(path) for path in batch])
+        await embedded.put((batch, embeddings))
+
+    await embedded.put(None)
+
+
+def add(index: faiss.Index, ids: list[str], pending: list[tuple[list[Path], np.ndarray]]):
+    if not index.is_trained:
+        index.train(np.concatenate([embeddings for _, embeddings in pending]))  # type: ignore
+
+    for batch, embeddings in pending:
+        index.add(embeddings)  # type: ignore
+        ids += [path.stem for path in batch]
+
+
+async def collect(
+    index: faiss.Index,
+    ids: list[str],
+    embedded: asyncio.Queue[tuple[list[Path], np.ndarray] | None],
+):
+    # The only stage touching the index, so ids and vectors are appended together
+    pending: list[tuple[list[Path], np.ndarray]] = []
+    progress = tqdm(unit="img")
+    finished = 0
+    added = 0
+
+    while finished < IN_FLIGHT:
+        if (item := await embedded.get()) is None:
+            finished += 1
+            continue
+
+        pending.append(item)
+        progress.update(len(item[0]))
+
+        # Trainable indexes hold back the first TRAIN_SIZE embeddings to train
+        # on, so nothing is embedded twice
+        if not index.is_trained and sum(len(batch) for batch, _ in pending) < TRAIN_SIZE:
+            continue
+
+        # Training, HNSW inserts and commits take seconds, off the event loop
+        # they don't hold up requests while warm-up rebuilds
+        await asyncio.to_thread(add, index, ids, pending)
+        added += sum(len(batch) for batch, _ in pending)
+        pending = []
+
+        # Checkpoint so a crash only loses the batches since the last commit.
+        # Every commit rewrites the whole index, so the gap grows with it and
+        # a cold build writes O(n) bytes rather than O(n²).
+        if added >= max(CHECKPOINT_EVERY * BATCH_SIZE, CHECKPOINT_GROWTH * (index.ntotal - added)):
+            await asyncio.to_thread(checkpoint, index, ids)
+            added = 0
+
+    if pending:
+        await asyncio.to_thread(add, index, ids, pending)
+
+    progress.close()
+    await asyncio.to_thread(checkpoint, index, ids)
+
+
+def prepare() -> tuple[faiss.Index, list[str], list[Path]]:
+    # The index to extend, its ids and the images on disk not in it yet
+    recover()
+
+    index, ids = load_index() if INDEX.exists() else (new_index(), [])
+
+    # THIRD_EYE_INDEX changed since the snapshot was built
+    if not is_kind(index):
+        print(f"Index isn't {INDEX_TYPE!r} ({INDEX_TYPES[INDEX_TYPE]}), rebuilding")
+
+        index = convert(index)
+        ids = ids if index.ntotal else []
+
+        checkpoint(index, ids)
+
+    # Snapshots from before the id tables existed
+    if not all(path.exists() for path in SNAPSHOT):
+        checkpoint(index, ids)
+
+    known = card_ids()
+
+    # Drop printings that are no longer in the bulk data
+    if stale := [i for i, id in enumerate(ids) if card_id(id) not in known]:
+        index = without(index, stale)
+
+        dropped = set(stale)
+        ids = [id for i, id in enumerate(ids) if i not in dropped]
+
+        checkpoint(index, ids)
+
+    # Images are written under a temporary name and renamed, so anything
+    # matching *.jpg is complete even while downloads are running
+    indexed = set(ids)
+    paths = [path for path in sorted(IMAGES.glob("*.jpg")) if path.stem not in indexed and card_id(path.stem) in known]
+
+    return index, ids, paths
+
+
+async def update_index(client: EmbedClient, downloads: asyncio.Queue[Path | None] | None = None):
+    # Builds are a pipeline: producer -> IN_FLIGHT embedders -> one collector,
+    # with bounded queues in between for backpressure. With a downloads queue
+    # images are embedded as soon as scrycache has written them, until it
+    # sends None.
+    index, ids, paths = await asyncio.to_thread(prepare)
+    indexed = set(ids)
+
+    if not paths and downloads is None:
+        return
+
+    batches: asyncio.Queue[list[Path] | None] = asyncio.Queue(IN_FLIGHT)
+    embedded: asyncio.Queue[tuple[list[Path], np.ndarray] | None] = asyncio.Queue(IN_FLIGHT)
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(produce(paths, downloads, indexed, batches))
+
+        for _ in range(IN_FLIGHT):
+            tg.create_task(embed(client, batches, embedded))
+
+        tg.create_task(collect(index, ids, embedded))
@@ -0,0 +1,103 @@
+import json
+
+import numpy as np
+
+from telemetry import SIZES, registry, timed
+
+from .client import EmbedClient
+from .crops import crop_name
+from .db import Database, get_results, save_results
+from .index import DIMENSIONS, Restriction, SearchIndex
+from .paths import OBJECTS
+from .yolo import detect_and_embed
+
+K = 9
+
+type Boxes = list[list[list[float]]]
+
+# cached: served as saved, searched: saved embeddings searched again, detected: new
+results_total = registry.counter("recognize_results_total", "Recognized objects by where the result came from")
+search_vectors = registry.histogram("search_batch_vectors", "Embeddings per index search", SIZES)
+
+
+async def recognize(
+    client: EmbedClient,
+    index: SearchIndex,
+    db: Database,
+    model: str,
+    object_ids: list[str],
+    restriction: Restriction | None = None,
+) -> list[tuple[Boxes, list[dict]]]:
+    # Objects are content addressed, so whatever was worked out for one before
+    # still holds as long as the models and the index haven't changed. Only
+    # the latest search is kept, restricted or not.
+    version = index.version if restriction is None else f"{index.version}|{restriction.key}"
+    cached = await db.read(get_results, object_ids, model)
+    results: dict[str, tuple[Boxes, list[dict]]] = {}
+    pending: dict[str, tuple[Boxes, np.ndarray]] = {}
+
+    for object_id, (index_version, saved_boxes, vectors, saved_candidates) in cached.items():
+        found = json.loads(saved_boxes)
+
+        if index_version == version:
+            results[object_id] = (found, json.loads(saved_candidates))
+            results_total.inc(source="cached")
+        else:
+            # The index was rebuilt or the restriction differs, the embeddings
+            # only need searching again
+            pending[object_id] = (found, np.frombuffer(vectors, np.float32).reshape(-1, DIMENSIONS))
+            results_total.inc(source="searched")
+
+    # Everything else goes through one detection request and one embedding batch
+    if missing := [id for id in dict.fromkeys(object_ids) if id not in cached]:
+        boxes, embeddings = await detect_and_embed(client, [OBJECTS / id for id in missing])
+        results_total.inc(len(missing), source="detected")
+        offset = 0
+
+        for object_id, found in zip(missing, boxes):
+            pending[object_id] = (found, embeddings[offset : offset + len(found)])
+            offset += len(found)
+
+    if pending:
+        # And one index search for all of them
+        embeddings = np.concatenate([embeddings for _, embeddings in pending.values()])
+        scores, ids = np.empty((0, K)), np.empty((0, K))
+
+        if len(embeddings):
+            search_vectors.observe(len(embeddings))
+
+            with timed("faiss"):
+                scores, ids = index.search(embeddings, K, restriction)
+
+        rows = []
+        offset = 0
+
+        for object_id, (found, embeddings) in pending.items():
+            # Crops are only warped and written once the UI asks for them
+            images = [crop_name(object_id, i) for i in range(len(found))]
+            hits = slice(offset, offset + len(found))
+            offset += len(found)
+
+            candidates = [
+                {
+                    "img": img,
+                    "matches": [{"id": id, "score": score} for id, score in zip(row_ids, row_scores) if id],
+                }
+                for img, row_ids, row_scores in zip(images, ids[hits].tolist(), scores[hits].tolist())
+            ]
+
+            results[object_id] = (found, candidates)
+            rows.append(
+                (
+                    object_id,
+                    model,
+                    version,
+                    json.dumps(found),
+                    np.ascontiguousarray(embeddings, np.float32).tobytes(),
+                    json.dumps(candidates),
+                )
+            )
+
+        await db.write(save_results, rows)
+
+    return [results[object_id] for object_id in object_ids]
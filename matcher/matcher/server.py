@@ -1,175 +1,199 @@
 import asyncio
+import hashlib
 import json
-import shutil
 from contextlib import asynccontextmanager
 from uuid import uuid4
 
-import faiss
-from fastapi import FastAPI, HTTPException, Query, Request, UploadFile
-from fastapi.responses import FileResponse
+from fastapi import Body, FastAPI, HTTPException, Query, Request, Response, UploadFile
+from fastapi.responses import FileResponse, JSONResponse
+from pydantic import BaseModel
 
-from scrycache import refresh_scryfall_cache
+from telemetry import CONTENT_TYPE, ServerTiming, registry, timed
 
+from .cards import CardStore
+from .client import EmbedClient
+from .crops import CropCache, parse_crop_name
 from .db import (
+    Database,
+    count_queued,
     dequeue_image,
+    dequeue_images,
+    get_boxes,
     get_session,
-    init_db,
     insert_match,
+    insert_matches,
     list_collection,
     list_queue,
     list_sessions,
     queue_image,
+    queue_images,
+    session_card_ids,
 )
-from .index import create_index, get_embeddings
-from .paths import CARDS, IDS, INDEX, OBJECTS, TMP
-from .yolo import get_bboxes
+from .paths import OBJECTS
+from .recognize import recognize
+from .services import NotReady, Services
+from .worker import QueueWorker
+from .yolo import get_bboxes, get_crop
+
+queue_depth = registry.gauge("queue_items", "Queued photos by status")
+crop_lookups = registry.counter("crop_lookups_total", "Crop images by whether they were on disk already")
 
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
-    await refresh_scryfall_cache()
+    # One pooled keep-alive client for every call to the embed server
+    client = EmbedClient()
 
-    if not INDEX.exists():
-        await create_index()
+    # Serve from the last snapshot right away, refreshing the caches and
+    # rebuilding the index happen in the background
+    services = Services(client)
+    await asyncio.to_thread(services.open_snapshot)
+    warm_up = asyncio.create_task(services.warm_up())
 
     # Prepare SQLite db
-    init_db()
-    sqlite_write_lock = asyncio.Lock()
-
-    index = faiss.read_index(str(INDEX))
-    ids = IDS.read_text().splitlines()
+    db = await asyncio.to_thread(Database)
+    crops = await asyncio.to_thread(CropCache)
 
-    cards = json.loads(CARDS.read_bytes())
-    cards = {card["id"]: card for card in cards}
+    # Recognizes queued photos in the background
+    worker = QueueWorker(services, db)
+    worker_task = asyncio.create_task(worker.run())
 
     yield {
-        "index": index,
-        "ids": ids,
-        "cards": cards,
-        "sqlite_write_lock": sqlite_write_lock,
+        "client": client,
+        "services": services,
+        "crops": crops,
+        "db": db,
+        "worker": worker,
     }
 
-    shutil.rmtree(TMP)
+    warm_up.cancel()
+    worker_task.cancel()
+    db.close()
+    services.close()
+    await client.aclose()
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(ServerTiming)
 
 
-async def save_object(image: UploadFile) -> str:
-    object_id = str(uuid4())
-    path = OBJECTS / object_id
-    path.write_bytes(await image.read())
-    return object_id
+@app.exception_handler(NotReady)
+async def not_ready(_: Request, error: NotReady):
+    return JSONResponse({"detail": f"Warming up: {error}"}, status_code=503, headers={"Retry-After": "5"})
 
 
-@app.post("/new-session")
-async def new_session() -> str:
-    return str(uuid4())
+@app.get("/livez")
+async def livez():
+    return {"status": "ok"}
 
 
-@app.post("/upload-image")
-async def upload(image: UploadFile) -> str:
-    return await save_object(image)
+@app.get("/readyz")
+async def readyz(request: Request):
+    services: Services = request.state.services
+    status = services.status()
 
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
 
-@app.get("/similar-from-image/{id}")
-async def similar(request: Request, id: str):
-    index: faiss.IndexFlatL2 = request.state.index
-    ids: list[str] = request.state.ids
 
-    path = OBJECTS / id
-    images = await get_bboxes(str(path))
+@app.get("/metrics")
+async def metrics(request: Request):
+    db: Database = request.state.db
 
-    if not images:
-        return []
+    # Counted at scrape time, the queue lives in SQLite
+    counts = await db.read(count_queued)
 
-    embeddings = await get_embeddings(images)
-    scores, indices = index.search(embeddings, k=9)  # type: ignore
+    for status in ("pending", "processing", "done", "failed"):
+        queue_depth.set(counts.get(status, 0), status=status)
 
-    result = []
+    return Response(registry.render(), media_type=CONTENT_TYPE)
 
-    for i, (scores, matches) in enumerate(zip(scores, indices)):
-        row = {"img": images[i], "matches": []}
 
-        for score, match in zip(scores, matches):
-            id = ids[match]
+async def save_object(image: UploadFile) -> tuple[str, bool]:
+    # Object id, and whether this call stored it
+    data = await image.read()
 
-            # handle multifaced ids: _1 or _2 suffix
-            if id[-2] == "_":
-                id = id[:-2]
+    # Content addressed, the same photo uploaded twice is stored once
+    object_id = hashlib.sha256(data).hexdigest()
+    path = OBJECTS / object_id
 
-            row["matches"].append({"id": id, "score": float(score)})
+    if path.exists():
+        return object_id, False
 
-        result.append(row)
+    with timed("upload"):
+        tmp = path.with_name(f"{object_id}.{uuid4().hex}.tmp")
+        tmp.write_bytes(data)
+        tmp.replace(path)
 
-    return result
+    return object_id, True
 
 
-@app.put("/match")
-async def match(request: Request, id: str, src: str, session: str):
-    lock: asyncio.Lock = request.state.sqlite_write_lock
+@app.post("/new-session")
+async def new_session() -> str:
+    return str(uuid4())
 
-    async with lock:
-        await asyncio.to_thread(insert_match, id, src, session)
 
+@app.post("/upload-image")
+async def upload(image: UploadFile) -> str:
+    object_id, _ = await save_object(image)
+    return object_id
 
-def extract_image_uri(card: dict) -> str:
-    if uris := card.get("image_uris"):
-        return uris.get("normal", None)
 
-    return card.get("card_faces", [])[0].get("image_uris", {}).get("normal", None)
+@app.get("/similar-from-image/{id}")
+async def similar(
+    request: Request,
+    id: str,
+    sets: list[str] = Query([], alias="set"),
+    lang: str | None = None,
+    session: str | None = None,
+):
+    state = request.state
+    index, model = state.services.searchable()
+    restriction = None
 
+    # Only search printings from these sets / in this language, a session
+    # adds the sets of the cards already matched in it
+    if sets or lang or session:
+        cards: CardStore = state.services.card_store()
 
-def usd_to_eur(price: str) -> str:
-    return str(float(price) * 0.86)
+        if session:
+            sets = [*sets, *cards.sets(await state.db.read(session_card_ids, session))]
 
+        sets = sorted(set(sets))
 
-def extract_price(card: dict) -> str:
-    foil = card["foil"]
-    nonfoil = card["nonfoil"]
-    prices = card["prices"]
+        # A session without matches yet doesn't narrow anything down
+        if sets or lang:
+            restriction = await state.services.restriction(index, sets, lang)
 
-    if foil and not nonfoil:
-        if price := prices["eur_foil"]:
-            return price
+    [(_, candidates)] = await recognize(state.client, index, state.db, model, [id], restriction)
 
-        if price := prices["usd_foil"]:
-            return usd_to_eur(price)
+    return candidates
 
-    if price := prices["eur"]:
-        return price
 
-    if price := prices["usd"]:
-        return usd_to_eur(price)
+@app.put("/match")
+async def match(request: Request, id: str, src: str, session: str):
+    db: Database = request.state.db
+    await db.write(insert_match, id, src, session)
 
-    return "0.00"
 
+class Match(BaseModel):
+    id: str
+    src: str
+    session: str
 
-def cards_by_id(cards: dict, ids: list[str]) -> list[dict]:
-    results = []
 
-    for id in ids:
-        if card := cards.get(id):
-            results.append(
-                {
-                    "id": id,
-                    "name": card["name"],
-                    "link": card["scryfall_uri"],
-                    "set": card["set"],
-                    "set_name": card["set_name"],
-                    "image": extract_image_uri(card),
-                    "price": extract_price(card),
-                    "edhrec": card.get("edhrec_rank", 0),
-                }
-            )
+@app.put("/matches")
+async def matches(request: Request, matches: list[Match]) -> list[dict]:
+    # Everything in one transaction, so a binder page costs one commit
+    db: Database = request.state.db
+    ids = await db.write(insert_matches, [(match.id, match.src, match.session) for match in matches])
 
-    return results
+    return [{"id": match.id, "match_id": id} for match, id in zip(matches, ids)]
 
 
 @app.get("/cards")
 async def cards(request: Request, ids: list[str] = Query()):
-    cards = request.state.cards
-    results = cards_by_id(cards, ids)
+    cards: CardStore = request.state.services.card_store()
+    results = cards.by_ids(ids)
 
     if not results:
         raise HTTPException(status_code=404, detail="No cards found")
@@ -178,18 +202,44 @@ async def cards(request: Request, ids: list[str] = Query()):
 
 
 @app.get("/session/{id}")
-async def session(id: str):
-    return await asyncio.to_thread(get_session, id)
+async def session(request: Request, id: str):
+    db: Database = request.state.db
+    return await db.read(get_session, id)
 
 
 @app.get("/sessions")
-async def sessions():
-    return await asyncio.to_thread(list_sessions)
+async def sessions(request: Request):
+    db: Database = request.state.db
+    return await db.read(list_sessions)
+
+
+@app.get("/crops/{name}")
+@app.get("/tmp/images/{name}")  # where crops used to be served from
+async def crop(request: Request, name: str):
+    crops: CropCache = request.state.crops
+
+    if path := crops.get(name):
+        crop_lookups.inc(result="hit")
+        return FileResponse(path)
+
+    crop_lookups.inc(result="miss")
+
+    # Evicted or never written, warp it again from the object and its saved box
+    if not (parsed := parse_crop_name(name)) or not (OBJECTS / parsed[0]).exists():
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    object_id, box = parsed
+    boxes = await request.state.db.read(get_boxes, object_id)
 
+    if boxes is None or box >= len(boxes := json.loads(boxes)):
+        raise HTTPException(status_code=404, detail="Image not found")
 
-@app.get("/tmp/images/{image}")
-async def tmp(image: str):
-    return FileResponse(TMP / image)
+    jpeg = await get_crop(request.state.client, str(OBJECTS / object_id), boxes[box])
+
+    with timed("crop-write"):
+        path = crops.put(name, jpeg)
+
+    return FileResponse(path)
 
 
 @app.get("/objects/{id}")
@@ -198,12 +248,14 @@ async def serve_object(id: str):
 
 
 @app.post("/detect")
-async def detect(image: UploadFile) -> dict:
-    object_id = await save_object(image)
+async def detect(request: Request, image: UploadFile) -> dict:
+    object_id, created = await save_object(image)
     path = OBJECTS / object_id
-    images = await get_bboxes(str(path))
+    images = await get_bboxes(request.state.client, str(path))
 
-    if not images:
+    # Only drop what this request stored, an earlier upload of the same photo
+    # may be matched, queued or have results pointing at it
+    if not images and created:
         path.unlink()
 
     return {"object_id": object_id, "count": len(images)}
@@ -211,34 +263,56 @@ async def detect(image: UploadFile) -> dict:
 
 @app.post("/queue/{object_id}")
 async def queue_existing(request: Request, object_id: str):
-    lock: asyncio.Lock = request.state.sqlite_write_lock
+    db: Database = request.state.db
 
     if not (OBJECTS / object_id).exists():
         raise HTTPException(status_code=404, detail="Object not found")
 
-    async with lock:
-        await asyncio.to_thread(queue_image, object_id)
+    await db.write(queue_image, object_id)
+    request.state.worker.wake()
+
+
+@app.post("/queue")
+async def queue_many(request: Request, object_ids: list[str] = Body()) -> list[dict]:
+    db: Database = request.state.db
+
+    exists = [(OBJECTS / object_id).exists() for object_id in object_ids]
+    ids = iter(await db.write(queue_images, [id for id, ok in zip(object_ids, exists) if ok]))
+    request.state.worker.wake()
+
+    return [
+        {"object_id": object_id, "id": next(ids)} if ok else {"object_id": object_id, "error": "Object not found"}
+        for object_id, ok in zip(object_ids, exists)
+    ]
 
 
 @app.get("/queue")
-async def queue_list():
-    return await asyncio.to_thread(list_queue)
+async def queue_list(request: Request):
+    db: Database = request.state.db
+    return await db.read(list_queue)
 
 
 @app.delete("/queue/{id}")
 async def queue_delete(request: Request, id: int):
-    lock: asyncio.Lock = request.state.sqlite_write_lock
-
-    async with lock:
-        await asyncio.to_thread(dequeue_image, id)
+    db: Database = request.state.db
+    await db.write(dequeue_image, id)
 
 
 @app.get("/collection")
 async def collection(
     request: Request,
 ):
-    cards = request.state.cards
-    ids = await asyncio.to_thread(list_collection)
+    cards: CardStore = request.state.services.card_store()
+    db: Database = request.state.db
+    ids = await db.read(list_collection)
     ids = [id for (id,) in ids]
 
-    return cards_by_id(cards, ids)
+    return cards.by_ids(ids)
+
+
+@app.delete("/queue")
+async def queue_delete_many(request: Request, ids: list[int] = Body()) -> list[dict]:
+    db: Database = request.state.db
+    deleted = await db.write(dequeue_images, ids)
+
+    return [{"id": id, "deleted": ok} for id, ok in zip(ids, deleted)]
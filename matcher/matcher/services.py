@@ -0,0 +1,167 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from scrycache import download_with_cache, refresh_bulk_data
+from telemetry import registry
+
+from .cards import CardStore, ensure_card_store, is_usable
+from .client import EmbedClient
+from .index import BATCH_SIZE, IN_FLIGHT, Restriction, SearchIndex, has_snapshot, update_index
+from .yolo import model_version
+
+EMBEDDER_POLL = 5  # seconds between attempts to reach the embed server
+RESTRICTIONS = int(os.environ.get("RESTRICTION_CACHE", 256))  # a bit per vector each
+
+
+class NotReady(Exception):
+    pass
+
+
+class Services:
+    # The parts of the matcher that warm-up replaces while requests are being
+    # served. Each is swapped by rebinding an attribute, so a request sees
+    # either the old or the new one, never something in between.
+    def __init__(self, client: EmbedClient):
+        self.client = client
+        self.index: SearchIndex | None = None
+        self.cards: CardStore | None = None
+        self.model: str | None = None
+
+        # (index version, restriction key) -> Restriction, least recently used first
+        self.restrictions: OrderedDict[tuple[str, str], Restriction] = OrderedDict()
+
+        self.ready = asyncio.Event()
+        self.stage = "starting"
+        self.error: str | None = None
+        self.started = time.monotonic()
+
+        registry.gauge("index_vectors", "Vectors in the index being served", self.vectors)
+        registry.gauge("ready", "Whether the index, card store and models are all in place", self.ready.is_set)
+
+    def open_snapshot(self):
+        # Whatever the last run left behind, possibly stale but good to serve
+        if is_usable():
+            self.cards = CardStore()
+
+        if has_snapshot() and (index := SearchIndex.open()).usable:
+            self.index = index
+
+    def vectors(self) -> int | None:
+        return self.index.index.ntotal if self.index is not None else None
+
+    def searchable(self) -> tuple[SearchIndex, str]:
+        if self.index is None or self.model is None:
+            raise NotReady(self.stage)
+
+        return self.index, self.model
+
+    def card_store(self) -> CardStore:
+        if self.cards is None:
+            raise NotReady(self.stage)
+
+        return self.cards
+
+    async def restriction(self, index: SearchIndex, sets: list[str], lang: str | None) -> Restriction:
+        key = f"set={','.join(sets)};lang={lang or ''}"
+
+        if (cached := self.restrictions.get((index.version, key))) is not None:
+            self.restrictions.move_to_end((index.version, key))
+            return cached
+
+        # The lookup stays on the event loop, see swap_cards, matching the ids
+        # against every vector's card takes long enough to block it
+        cards = self.card_store()
+        restriction = await asyncio.to_thread(index.restrict, cards.ids_where(sets, lang), key)
+
+        # Built from a card store that has since been replaced
+        if cards is not self.cards:
+            return restriction
+
+        self.restrictions[index.version, key] = restriction
+
+        while len(self.restrictions) > RESTRICTIONS:
+            self.restrictions.popitem(last=False)
+
+        return restriction
+
+    def update(self):
+        if self.index is not None and self.cards is not None and self.model is not None:
+            self.ready.set()
+
+    def swap_cards(self, cards: CardStore):
+        old, self.cards = self.cards, cards
+        self.restrictions.clear()
+        self.update()
+
+        # Lookups run on the event loop, so none can be using the old store
+        if old is not None:
+            old.close()
+
+    def swap_index(self, index: SearchIndex):
+        if not index.usable:
+            return
+
+        if self.index is None or self.index.version != index.version:
+            self.index = index
+            self.restrictions.clear()
+            self.update()
+
+    async def connect_embedder(self):
+        # Cached recognition results are only reused with the same models
+        self.stage = "waiting for embed server"
+
+        while self.model is None:
+            try:
+                self.model = await model_version(self.client)
+            except Exception as error:
+                print(f"✗ Embed server not reachable yet: {error}")
+                await asyncio.sleep(EMBEDDER_POLL)
+
+        self.update()
+
+    async def warm_up(self):
+        try:
+            await self.connect_embedder()
+
+            self.stage = "refreshing bulk data"
+            await refresh_bulk_data()
+
+            if await asyncio.to_thread(ensure_card_store) or self.cards is None:
+                self.swap_cards(CardStore())
+
+            # Index images as they download rather than after the whole cache is warm
+            self.stage = "indexing"
+            downloads: asyncio.Queue[Path | None] = asyncio.Queue(BATCH_SIZE * IN_FLIGHT)
+
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(download_with_cache(downloads))
+                tg.create_task(update_index(self.client, downloads))
+
+            # Nothing is committed until there's something to search
+            if has_snapshot():
+                self.swap_index(await asyncio.to_thread(SearchIndex.open))
+            self.stage = "ready"
+
+        except Exception as error:
+            # Keep serving the last snapshot, a restart retries the refresh
+            self.stage = "failed"
+            self.error = repr(error)
+            print(f"✗ Warm-up failed: {error!r}")
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready.is_set(),
+            "stage": self.stage,
+            "error": self.error,
+            "uptime": time.monotonic() - self.started,
+            "index": {"version": self.index.version, "vectors": self.index.index.ntotal} if self.index else None,
+            "cards": self.cards is not None,
+            "model": self.model,
+        }
+
+    def close(self):
+        if self.cards is not None:
+            self.cards.close()
@@ -0,0 +1,75 @@
+import asyncio
+import os
+
+from telemetry import SIZES, registry
+
+from .db import Database, claim_queued, finish_queued, reset_processing
+from .paths import OBJECTS
+from .recognize import recognize
+from .services import Services
+
+QUEUE_BATCH = int(os.environ.get("QUEUE_BATCH", 16))  # photos per detection and embedding round
+QUEUE_CONCURRENCY = int(os.environ.get("QUEUE_CONCURRENCY", 2))  # rounds in flight
+IDLE_POLL = 30  # seconds, queue endpoints wake the worker sooner
+
+claimed = registry.histogram("queue_batch_size", "Queued photos recognized per round", SIZES)
+processed = registry.counter("queue_processed_total", "Queued photos by outcome")
+
+
+class QueueWorker:
+    def __init__(self, services: Services, db: Database):
+        self.services = services
+        self.db = db
+        self.wakeup = asyncio.Event()
+
+    def wake(self):
+        self.wakeup.set()
+
+    async def run(self):
+        await self.db.write(reset_processing)
+
+        # Nothing can be recognized before there is an index to search
+        await self.services.ready.wait()
+
+        slots = asyncio.Semaphore(QUEUE_CONCURRENCY)
+        running: set[asyncio.Task] = set()
+
+        while True:
+            await slots.acquire()
+            self.wakeup.clear()
+
+            if not (items := await self.db.write(claim_queued, QUEUE_BATCH)):
+                slots.release()
+
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), IDLE_POLL)
+                except TimeoutError:
+                    pass
+
+                continue
+
+            claimed.observe(len(items))
+            task = asyncio.create_task(self.process(items))
+            running.add(task)
+
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+    async def process(self, items: list[tuple[int, str]]):
+        failed = [(id, "Object not found") for id, object_id in items if not (OBJECTS / object_id).exists()]
+        items = [(id, object_id) for id, object_id in items if (OBJECTS / object_id).exists()]
+
+        try:
+            # Picks up a rebuilt index from the next batch on
+            index, model = self.services.searchable()
+            object_ids = [object_id for _, object_id in items]
+
+            await recognize(self.services.client, index, self.db, model, object_ids)
+        except Exception as error:
+            failed += [(id, str(error)) for id, _ in items]
+            items = []
+
+        processed.inc(len(items), outcome="done")
+        processed.inc(len(failed), outcome="failed")
+
+        await self.db.write(finish_queued, [id for id, _ in items], failed)
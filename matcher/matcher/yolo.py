@@ -1,15 +1,35 @@
-from httpx import AsyncClient
+import json
+from pathlib import Path
 
+import numpy as np
 
-async def get_bboxes(img: str) -> list[str]:
-    async with AsyncClient() as client:
-        result = await client.post(
-            "http://localhost:8000/bbox",
-            params={"img": img},
-            timeout=60,
-        )
+from .client import EmbedClient
+from .index import BINARY, read_embeddings
 
-    result.raise_for_status()
-    json = result.json()
 
-    return json
+async def get_bboxes(client: EmbedClient, img: str) -> list[list[list[float]]]:
+    result = await client.post("/bbox", params={"img": img})
+    return result.json()
+
+
+async def detect_and_embed(
+    client: EmbedClient,
+    paths: list[Path],
+) -> tuple[list[list[list[list[float]]]], np.typing.NDArray[np.float32]]:
+    files = [("images", (path.name, path.read_bytes())) for path in paths]
+    result = await client.post("/detect-embed", files=files, headers=BINARY)
+
+    # The boxes are JSON ahead of the embedding rows
+    size = int(result.headers["X-Boxes-Length"])
+    return json.loads(result.content[:size]), read_embeddings(result, size)
+
+
+async def get_crop(client: EmbedClient, img: str, points: list[list[float]]) -> bytes:
+    result = await client.post("/crop", params={"img": img}, json=points)
+    return result.content
+
+
+async def model_version(client: EmbedClient) -> str:
+    result = await client.get("/version")
+    version = result.json()
+    return f"{version['embedder']}:{version['detector']}"
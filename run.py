@@ -9,7 +9,7 @@ def run_embedding_server():
 
 
 def run_matcher_server():
-    uvicorn.run("matcher.matcher.server:app", host="0.0.0.0", port=8001)
+    uvicorn.run("matcher.server:app", host="0.0.0.0", port=8001)
 
 
 def run_ui():
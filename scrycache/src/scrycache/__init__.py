@@ -1,5 +1,25 @@
-from .cache import download_with_cache
+import asyncio
+from pathlib import Path
 
+import httpx
 
-async def refresh_scryfall_cache():
-    await download_with_cache()
+from .cache import CARDS, download_bulk_data, download_with_cache
+
+__all__ = ["download_with_cache", "refresh_bulk_data", "refresh_scryfall_cache"]
+
+
+async def refresh_bulk_data():
+    try:
+        await download_bulk_data()
+
+    except httpx.HTTPError as error:
+        # A stale snapshot beats not starting at all
+        if not CARDS.exists():
+            raise
+
+        print(f"✗ Failed to refresh bulk data, using cached cards.json: {error}")
+
+
+async def refresh_scryfall_cache(downloaded: asyncio.Queue[Path | None] | None = None):
+    await refresh_bulk_data()
+    await download_with_cache(downloaded)
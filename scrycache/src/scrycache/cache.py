@@ -1,5 +1,7 @@
 import asyncio
+import contextlib
 import json
+import os
 import typing as T
 from pathlib import Path
 
@@ -9,24 +11,111 @@ SCRYFALL_BULK_URI = "https://api.scryfall.com/bulk-data"
 
 CACHE = Path.home() / ".cache/third-eye"
 CARDS = CACHE / "cards.json"
+PART = CACHE / "cards.json.part"
+BULK_META = CACHE / "cards.meta.json"
 IMAGES = CACHE / "images"
+IMAGE_MANIFEST = CACHE / "images.json"
+
+CHUNK_SIZE = 1 << 20
 
 CACHE.mkdir(exist_ok=True)
 IMAGES.mkdir(exist_ok=True)
 
 
-def download_bulk_data():
-    response = httpx.get(SCRYFALL_BULK_URI, timeout=60)
-    response.raise_for_status()
+def read_json(path: Path) -> dict:
+    if path.exists():
+        return json.loads(path.read_text())
+
+    return {}
+
+
+def write_atomic(path: Path, data: bytes):
+    # Readers, like the indexer globbing images mid-download, only ever see
+    # a complete file. The temporary name doesn't match *.jpg or *.json.
+    tmp = path.with_name(f"{path.name}.tmp")
+    tmp.write_bytes(data)
+    tmp.replace(path)
+
+
+def write_json(path: Path, data: dict):
+    write_atomic(path, json.dumps(data).encode())
+
+
+def sync(f: T.BinaryIO):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def read_meta() -> dict:
+    return read_json(BULK_META)
+
+
+def write_meta(meta: dict):
+    write_json(BULK_META, meta)
+
+
+async def download_bulk_data() -> bool:
+    """Refresh cards.json, returns whether it changed."""
+    meta = read_meta()
+
+    async with httpx.AsyncClient(timeout=60, follow_redirects=True) as client:
+        response = await client.get(SCRYFALL_BULK_URI)
+        response.raise_for_status()
+
+        entry = next(each for each in response.json()["data"] if each["type"] == "default_cards")
+        version = entry["updated_at"]
+
+        if CARDS.exists() and meta.get("updated_at") == version:
+            return False
+
+        headers = {}
+        offset = 0
+
+        # Pick an interrupted transfer of the same version back up where it
+        # stopped. If-Range makes the server send everything if it changed.
+        if PART.exists() and meta.get("partial") == version and (etag := meta.get("partial_etag")):
+            offset = PART.stat().st_size
+            headers = {"Range": f"bytes={offset}-", "If-Range": etag}
+
+        # Only worth asking when there is a file to keep, otherwise a 304
+        # would leave nothing at all
+        elif CARDS.exists() and (etag := meta.get("etag")):
+            headers = {"If-None-Match": etag}
+
+        async with client.stream("GET", entry["download_uri"], headers=headers) as data:
+            if data.status_code == 304:
+                write_meta({**meta, "updated_at": version})
+                return False
+
+            # Nothing past the end of the part file: it was complete and
+            # synced, only the rename below didn't happen
+            if data.status_code == 416 and offset:
+                etag = meta["partial_etag"]
+
+            else:
+                data.raise_for_status()
+                etag = data.headers.get("etag")
 
-    for each in response.json().get("data"):
-        if not each["type"] == "default_cards":
-            continue
+                if data.status_code != 206:
+                    offset = 0
 
-        data = httpx.get(each["download_uri"])
-        data.raise_for_status()
+                write_meta({**meta, "partial": version, "partial_etag": etag})
 
-        CARDS.write_bytes(data.content)
+                # Streamed in chunks so memory stays flat however big the file
+                # is. Writes and the fsync go through threads, this runs while
+                # the matcher is serving.
+                with await asyncio.to_thread(PART.open, "ab" if offset else "wb") as f:
+                    async for chunk in data.aiter_bytes(CHUNK_SIZE):
+                        await asyncio.to_thread(f.write, chunk)
+
+                    await asyncio.to_thread(sync, f)
+
+    await asyncio.to_thread(PART.replace, CARDS)
+    write_meta({"updated_at": version, "etag": etag})
+
+    print(f"✓ Downloaded bulk data {version}")
+
+    return True
 
 
 class ImageUris(T.TypedDict):
@@ -93,46 +182,115 @@ async def download_image(
     id: str,
     uri: str,
     path: Path,
-) -> bool:
+    downloaded: asyncio.Queue[Path | None] | None = None,
+) -> int | None:
+    # Size written, None when the download failed
     async with semaphore:
         try:
             response = await client.get(uri)
             response.raise_for_status()
 
-            await asyncio.to_thread(path.write_bytes, response.content)
+            await asyncio.to_thread(write_atomic, path, response.content)
             print(f"✓ Downloaded {id}")
 
-            return True
+            # Blocks while the consumer is behind, which throttles downloads
+            if downloaded is not None:
+                await downloaded.put(path)
+
+            return len(response.content)
 
         except Exception as error:
             print(f"✗ Failed {id}: {error}")
 
-            return False
+            return None
 
 
-async def download_with_cache():
-    if not CARDS.exists():
-        download_bulk_data()
+async def download_with_cache(downloaded: asyncio.Queue[Path | None] | None = None):
+    try:
+        await download_images(downloaded)
+    except BaseException:
+        # Failed or cancelled, likely because the consumer is gone, so waiting
+        # for room in the queue could block forever. Best effort only.
+        if downloaded is not None:
+            with contextlib.suppress(asyncio.QueueFull):
+                downloaded.put_nowait(None)
+
+        raise
+
+    # Tell the consumer there is nothing more coming
+    if downloaded is not None:
+        await downloaded.put(None)
+
+
+def plan_downloads() -> tuple[dict[str, list], list[Downloadable]]:
+    # Manifest entries that are still current, and the images to fetch
+
+    # Left behind by downloads that were interrupted mid-write
+    for tmp in IMAGES.glob("*.jpg.tmp"):
+        tmp.unlink(missing_ok=True)
 
     cards: list[Card] = json.loads(CARDS.read_bytes())
 
+    # Image id -> source URI and size, URIs change when Scryfall updates an image
+    known = read_json(IMAGE_MANIFEST)
+    manifest: dict[str, list] = {}
+
     to_download: list[Downloadable] = []
 
     for card in cards:
         for image in downloadable(card):
-            if not image.path.exists():
-                to_download.append(image)
+            if (entry := known.get(image.id)) is not None:
+                if entry[0] == image.uri:
+                    manifest[image.id] = entry
+                    continue
+
+            # Downloaded before the manifest was kept
+            elif image.path.exists():
+                manifest[image.id] = [image.uri, image.path.stat().st_size]
+                continue
+
+            to_download.append(image)
+
+    return manifest, to_download
+
+
+async def download_images(downloaded: asyncio.Queue[Path | None] | None):
+    if not CARDS.exists():
+        await download_bulk_data()
+
+    meta = read_meta()
+    version = meta.get("updated_at")
+
+    # Every image of this bulk data version is on disk already
+    if version is not None and meta.get("images") == version:
+        print(f"✓ Images up to date with bulk data {version}")
+        return
+
+    # Parsing hundreds of MB of cards takes seconds, requests keep being
+    # served meanwhile
+    manifest, to_download = await asyncio.to_thread(plan_downloads)
 
     semaphore = asyncio.Semaphore(100)
 
     async with httpx.AsyncClient() as client:
         async with asyncio.TaskGroup() as tg:
-            tasks = [tg.create_task(download_image(semaphore, client, id, uri, path)) for id, uri, path in to_download]
+            tasks = [
+                tg.create_task(download_image(semaphore, client, id, uri, path, downloaded))
+                for id, uri, path in to_download
+            ]
 
     success = 0
 
-    for task in tasks:
-        if task.result():
+    for (id, uri, _), task in zip(to_download, tasks):
+        if (size := task.result()) is not None:
+            manifest[id] = [uri, size]
             success += 1
 
+    await asyncio.to_thread(write_json, IMAGE_MANIFEST, manifest)
+
+    # Only a complete download lets the next start skip the scan, failures
+    # are retried then
+    if success == len(to_download):
+        write_meta({**read_meta(), "images": version})
+
     print(f"✓ Downloaded {success}/{len(to_download)} images")
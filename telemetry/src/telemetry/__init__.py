@@ -0,0 +1,267 @@
+import math
+import threading
+import time
+import typing as T
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Prometheus text exposition without the client library. Recording is a dict
+# lookup and a few additions under a lock, cheap enough to leave on.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from sub-millisecond index searches to multi-second detection batches
+LATENCY = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZES = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+type Labels = tuple[tuple[str, str], ...]
+
+
+def labels_key(labels: dict[str, object]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in labels]
+
+    if extra:
+        pairs.append(extra)
+
+    return f"{{{','.join(pairs)}}}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+
+    def samples(self) -> T.Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", *self.samples()])
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = labels_key(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> T.Iterator[str]:
+        with self.lock:
+            values = list(self.values.items())
+
+        for labels, value in values:
+            yield f"{self.name}{format_labels(labels)} {format_value(value)}"
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    # Either set explicitly or read from a callback at scrape time
+    def __init__(self, name: str, help: str, read: T.Callable[[], float | None] | None = None):
+        super().__init__(name, help)
+        self.values: dict[Labels, float] = {}
+        self.read = read
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[labels_key(labels)] = value
+
+    def samples(self) -> T.Iterator[str]:
+        if self.read is not None:
+            if (value := self.read()) is not None:
+                yield f"{self.name} {format_value(value)}"
+
+            return
+
+        with self.lock:
+            values = list(self.values.items())
+
+        for labels, value in values:
+            yield f"{self.name}{format_labels(labels)} {format_value(value)}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: T.Sequence[float] = LATENCY):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+        # Per label set: count per bucket (the last one is +Inf), then the sum
+        self.values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = labels_key(labels)
+        slot = bisect_left(self.buckets, value)
+
+        with self.lock:
+            if (entry := self.values.get(key)) is None:
+                entry = self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+
+            counts, total = entry
+            counts[slot] += 1
+            total[0] += value
+
+    def snapshot(self, **labels) -> tuple[int, float]:
+        with self.lock:
+            if (entry := self.values.get(labels_key(labels))) is None:
+                return 0, 0.0
+
+            counts, total = entry
+            return sum(counts), total[0]
+
+    def samples(self) -> T.Iterator[str]:
+        with self.lock:
+            values = [(labels, list(counts), total[0]) for labels, (counts, total) in self.values.items()]
+
+        for labels, counts, total in values:
+            cumulative = 0
+
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(labels, f'le="{format_value(bound)}"')} {cumulative}"
+
+            yield f"{self.name}_sum{format_labels(labels)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(labels)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def add[M: Metric](self, metric: M) -> M:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.add(Counter(name, help))
+
+    def gauge(self, name: str, help: str, read: T.Callable[[], float | None] | None = None) -> Gauge:
+        return self.add(Gauge(name, help, read))
+
+    def histogram(self, name: str, help: str, buckets: T.Sequence[float] = LATENCY) -> Histogram:
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram("stage_seconds", "Time spent per stage of request handling")
+request_seconds = registry.histogram("http_request_seconds", "Request latency by route")
+requests_total = registry.counter("http_requests_total", "Requests by route and status")
+
+# Stage name -> seconds, for the request being handled, None outside of one
+timings: ContextVar[dict[str, float] | None] = ContextVar("timings", default=None)
+
+
+def record(stage: str, seconds: float):
+    stage_seconds.observe(seconds, stage=stage)
+
+    if (current := timings.get()) is not None:
+        current[stage] = current.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def merge(stages: dict[str, float], prefix: str):
+    # Stages another server timed for this request, it keeps their histograms
+    if (current := timings.get()) is not None:
+        for stage, seconds in stages.items():
+            current[f"{prefix}{stage}"] = current.get(f"{prefix}{stage}", 0.0) + seconds
+
+
+def server_timing(stages: dict[str, float]) -> str:
+    return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in stages.items())
+
+
+def parse_server_timing(header: str) -> dict[str, float]:
+    # Only what server_timing writes: name;dur=milliseconds
+    stages = {}
+
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+
+            if key == "dur" and name:
+                try:
+                    stages[name] = float(value) / 1000
+                except ValueError:
+                    pass
+
+    return stages
+
+
+class ServerTiming:
+    # ASGI middleware: collects the stages timed while handling a request,
+    # returns them in a Server-Timing header and records the request latency
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stages: dict[str, float] = {}
+        token = timings.set(stages)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_timed(message):
+            nonlocal status
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                stages["total"] = time.perf_counter() - start
+
+                header = server_timing(stages).encode()
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", header)]}
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            timings.reset(token)
+
+            # The route template, so ids in paths don't each get a series
+            route = getattr(scope.get("route"), "path", "unmatched")
+
+            request_seconds.observe(time.perf_counter() - start, route=route)
+            requests_total.inc(route=route, status=status)
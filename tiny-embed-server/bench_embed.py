@@ -0,0 +1,95 @@
+import argparse
+import gc
+import json
+import time
+from itertools import batched, islice
+
+import numpy as np
+import torch
+from matcher.index import load_index
+from matcher.paths import IMAGES
+from PIL import Image
+
+# Run as a script, from the repo root:
+# uv run --package tiny-embed-server --group bench tiny-embed-server/bench_embed.py
+# This package can't be imported by name, so models comes from the script's
+# own directory, matcher is the installed workspace package.
+from models import BACKENDS, load, pixel_values  # isort: skip
+
+
+def sample(ids: list[str], n: int, seed: int) -> list[str]:
+    # Reference images that are in the baseline index and still on disk
+    rng = np.random.default_rng(seed)
+    picks = rng.permutation(len(ids))
+
+    return list(islice((ids[i] for i in picks if (IMAGES / f"{ids[i]}.jpg").exists()), n))
+
+
+def run(backend: str, batches: list[torch.Tensor]) -> tuple[np.ndarray, float]:
+    embed = load(backend)
+    embed(batches[0])  # warm-up
+
+    start = time.perf_counter()
+    embeddings = np.concatenate([embed(batch) for batch in batches])
+    elapsed = time.perf_counter() - start
+
+    del embed
+    gc.collect()
+
+    return embeddings, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and match agreement of embedding backends")
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument("--baseline", default="bf16", choices=BACKENDS, help="backend the others are compared to")
+    parser.add_argument("-n", type=int, default=512, help="reference images to embed")
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    index, ids = load_index()
+    queries = sample(ids, args.n, seed=0)
+
+    # Decoded and preprocessed once, so only the backends are timed
+    pixels = [
+        pixel_values([Image.open(IMAGES / f"{id}.jpg").convert("RGB") for id in chunk])
+        for chunk in batched(queries, args.batch)
+    ]
+
+    backends = [args.baseline, *(backend for backend in args.backends if backend != args.baseline)]
+    baseline: tuple[np.ndarray, np.ndarray] | None = None
+
+    for backend in backends:
+        embeddings, elapsed = run(backend, pixels)
+        _, found = index.search(embeddings, 1)  # type: ignore
+        top1 = found[:, 0]
+
+        if baseline is None:
+            baseline = (embeddings, top1)
+
+        reference, reference_top1 = baseline
+        cosine = (embeddings * reference).sum(axis=1) / (
+            np.linalg.norm(embeddings, axis=1) * np.linalg.norm(reference, axis=1)
+        )
+
+        result = {
+            "backend": backend,
+            "images": len(queries),
+            "images_per_s": round(len(queries) / elapsed, 1),
+            # The image's own entry in the baseline index comes out on top
+            "self@1": round(float(np.mean([ids[i] == id for i, id in zip(top1, queries)])), 4),
+            # Same top-1 as the baseline backend, what decides whether match results change
+            "agree@1": round(float((top1 == reference_top1).mean()), 4),
+            "cosine_min": round(float(cosine.min()), 4),
+            "cosine_mean": round(float(cosine.mean()), 4),
+        }
+
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print("  ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
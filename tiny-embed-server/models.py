@@ -0,0 +1,134 @@
+import os
+import threading
+import typing as T
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import ImageFile
+from transformers import AutoConfig, AutoModel, AutoProcessor
+
+MODEL = "facebook/dinov3-vits16-pretrain-lvd1689m"
+
+# bf16 suits GPUs. CPUs without native bf16 matmuls are usually faster in fp32,
+# and faster still with int8 or ONNX Runtime, see bench_embed.py.
+BACKENDS = ("bf16", "fp32", "int8", "compile", "onnx")
+BACKEND = os.environ.get("EMBED_BACKEND", "bf16")
+
+ONNX = Path.home() / ".cache/third-eye" / f"{MODEL.split('/')[-1]}.onnx"
+
+processor = AutoProcessor.from_pretrained(MODEL, use_fast=True)
+DIMENSIONS = AutoConfig.from_pretrained(MODEL).hidden_size
+
+# Reference images preprocessed by tensors.py are already at this resolution
+INPUT_SIZE = (processor.size["height"], processor.size["width"])
+MEAN = torch.tensor(processor.image_mean).view(1, 3, 1, 1)
+STD = torch.tensor(processor.image_std).view(1, 3, 1, 1)
+
+# Pixel values in, pooled float32 embeddings out
+type Embedder = T.Callable[[torch.Tensor], np.ndarray]
+
+exporting = threading.Lock()
+
+
+def pixel_values(images: list[ImageFile.ImageFile] | list[np.ndarray]) -> torch.Tensor:
+    # Batches made up of preprocessed images only need rescaling and
+    # normalizing, anything else goes through the full processor
+    if images and all(isinstance(image, np.ndarray) and image.shape == (*INPUT_SIZE, 3) for image in images):
+        pixels = torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2).float()
+        return (pixels * processor.rescale_factor - MEAN) / STD
+
+    return processor(images=images, return_tensors="pt")["pixel_values"]
+
+
+def load_model(dtype: torch.dtype = torch.float32, **kwargs) -> torch.nn.Module:
+    return AutoModel.from_pretrained(MODEL, dtype=dtype, attn_implementation="sdpa", **kwargs).eval()
+
+
+def torch_embedder(model: T.Callable, device: torch.device, dtype: torch.dtype) -> Embedder:
+    @torch.inference_mode()
+    def embed(pixels: torch.Tensor) -> np.ndarray:
+        outputs = model(pixel_values=pixels.to(device, dtype))
+        return outputs.pooler_output.float().cpu().numpy()
+
+    return embed
+
+
+class Pooled(torch.nn.Module):
+    # The exported graph returns a plain tensor rather than a ModelOutput
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.model(pixel_values=pixel_values).pooler_output
+
+
+def export_onnx(path: Path = ONNX) -> Path:
+    with exporting:
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{path.name}.tmp")
+
+            torch.onnx.export(
+                Pooled(load_model()),
+                (torch.zeros(1, 3, *INPUT_SIZE),),
+                str(tmp),
+                input_names=["pixel_values"],
+                output_names=["pooler_output"],
+                dynamic_axes={"pixel_values": {0: "batch"}, "pooler_output": {0: "batch"}},
+                opset_version=17,
+                dynamo=False,
+            )
+
+            tmp.replace(path)
+
+    return path
+
+
+def onnx_embedder(path: Path) -> Embedder:
+    import onnxruntime as ort
+
+    # Same thread budget per inference worker as torch gets
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = torch.get_num_threads()
+    options.inter_op_num_threads = 1
+
+    session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+
+    def embed(pixels: torch.Tensor) -> np.ndarray:
+        return session.run(None, {"pixel_values": pixels.float().numpy()})[0]  # type: ignore
+
+    return embed
+
+
+def load(backend: str = BACKEND) -> Embedder:
+    cpu = torch.device("cpu")
+
+    match backend:
+        case "bf16":
+            model = load_model(torch.bfloat16, device_map="auto")
+            return torch_embedder(model, model.device, torch.bfloat16)
+
+        case "fp32":
+            return torch_embedder(load_model(), cpu, torch.float32)
+
+        case "int8":
+            # Linear layers hold nearly all of a ViT's weights and FLOPs
+            model = torch.ao.quantization.quantize_dynamic(load_model(), {torch.nn.Linear}, dtype=torch.qint8)
+            return torch_embedder(model, cpu, torch.float32)
+
+        case "compile":
+            embed = torch_embedder(torch.compile(load_model(), dynamic=True), cpu, torch.float32)
+
+            # Compile up front, batches of one are specialized separately
+            for size in (1, 2):
+                embed(torch.zeros(size, 3, *INPUT_SIZE))
+
+            return embed
+
+        case "onnx":
+            return onnx_embedder(export_onnx())
+
+        case _:
+            raise ValueError(f"Unknown embedding backend {backend!r}, expected one of {BACKENDS}")
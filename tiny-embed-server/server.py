@@ -1,40 +1,225 @@
+import asyncio
+import json
+import os
+import time
+import typing as T
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
 from itertools import batched
 
+import numpy as np
 import torch
-from fastapi import FastAPI
+from fastapi import Body, FastAPI, Request, Response, UploadFile
 from PIL import Image, ImageFile
-from transformers import AutoModel, AutoProcessor
 
-from extractor import find_all_cards_from_obbox
+from extractor import detector_version, encode_crop, find_all_cards_from_obbox, find_all_cards_in_memory_batch
+from telemetry import CONTENT_TYPE, SIZES, ServerTiming, registry, timed
 
-app = FastAPI()
+from .models import BACKEND, DIMENSIONS, INPUT_SIZE, MODEL, load, pixel_values
+from .tensors import TensorCache
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-MODEL = "facebook/dinov3-vits16-pretrain-lvd1689m"
+# Raw little-endian float32 rows, shape in the X-Embedding-Shape header. For
+# /detect-embed the boxes come first, X-Boxes-Length bytes of JSON.
+BINARY = "application/octet-stream"
 
-processor = AutoProcessor.from_pretrained(MODEL, use_fast=True)
-model = AutoModel.from_pretrained(
-    MODEL,
-    dtype=torch.bfloat16,
-    device_map="auto",
-    attn_implementation="sdpa",
-)
+# Crops from concurrent requests are coalesced into one forward pass of up to
+# MAX_BATCH images, waiting at most MAX_WAIT for a batch to fill up
+MAX_BATCH = int(os.environ.get("EMBED_MAX_BATCH", 128))
+MAX_WAIT = float(os.environ.get("EMBED_MAX_WAIT_MS", 10)) / 1000
 
+# YOLO and DINO run on this pool so the event loop never blocks on inference.
+# Each worker gets an equal share of torch's intra-op threads to avoid
+# oversubscribing the cores when every worker is busy. More workers trade
+# single scan latency for throughput under concurrent load: a pass only runs
+# on cores / workers threads, so with one scanner active most cores idle.
+# Two keeps a lone pass on half the cores while the next batch gets ready.
+CORES = os.cpu_count() or 1
+WORKERS = int(os.environ.get("INFERENCE_WORKERS", min(2, CORES)))
+torch.set_num_threads(int(os.environ.get("TORCH_THREADS", max(1, CORES // WORKERS))))
 
-@torch.inference_mode()
-def get_embeddings(images: list[ImageFile.ImageFile]):
-    inputs = processor(images=images, return_tensors="pt").to(model.device)
-    outputs = model(**inputs)
-    embeddings = outputs.pooler_output
+executor = ThreadPoolExecutor(WORKERS, thread_name_prefix="inference")
 
-    return embeddings.float().cpu().tolist()
+embedder = load(BACKEND)
+
+tensors = TensorCache()
+
+batch_size = registry.histogram("embed_batch_size", "Images per embedding forward pass", SIZES)
+queue_wait = registry.histogram("embed_queue_wait_seconds", "Time requests wait for their batch to start")
+inference_seconds = registry.histogram("embed_inference_seconds", "Time per embedding forward pass")
+tensor_lookups = registry.counter("tensor_cache_lookups_total", "Reference images by preprocessed tensor cache result")
+
+
+def get_embeddings(images: list[ImageFile.ImageFile] | list[np.ndarray]) -> np.ndarray:
+    return embedder(pixel_values(images))
+
+
+def embed_batches(batches: Iterable[list]) -> np.ndarray:
+    features = [get_embeddings(batch) for batch in batches]
+
+    if not features:
+        return np.empty((0, DIMENSIONS), dtype=np.float32)
+
+    return np.concatenate(features)
+
+
+async def run_inference[**P, R](fn: T.Callable[P, R], *args: P.args, **kwargs: P.kwargs) -> R:
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(fn, *args, **kwargs))
+
+
+class Batcher:
+    def __init__(self, max_batch: int, max_wait: float):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue: asyncio.Queue[tuple[list, asyncio.Future, float]] = asyncio.Queue()
+        self.running = 0
+
+        registry.gauge("embed_queue_depth", "Requests waiting to be batched", self.queue.qsize)
+        registry.gauge("embed_batches_running", "Forward passes in flight", lambda: self.running)
+
+    async def embed(self, images: list) -> np.ndarray:
+        if not images:
+            return embed_batches([])
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((images, future, time.perf_counter()))
+
+        return await future
+
+    async def collect(self) -> list[tuple[list, asyncio.Future, float]]:
+        pending = [await self.queue.get()]
+        size = len(pending[0][0])
+        deadline = pending[0][2] + self.max_wait
+
+        while size < self.max_batch:
+            try:
+                timeout = max(0, deadline - time.perf_counter())
+                pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except TimeoutError:
+                break
+
+            size += len(pending[-1][0])
+
+        return pending
+
+    async def run(self, workers: int):
+        # Up to one batch per worker in flight. While all are busy the queue
+        # keeps filling, so batches grow under load.
+        slots = asyncio.Semaphore(workers)
+        running: set[asyncio.Task] = set()
+
+        while True:
+            await slots.acquire()
+            pending = await self.collect()
+
+            task = asyncio.create_task(self.flush(pending))
+            running.add(task)
+
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+    async def flush(self, pending: list[tuple[list, asyncio.Future, float]]):
+        started = time.perf_counter()
+
+        images = [image for request, _, _ in pending for image in request]
+        batches = [list(batch) for batch in batched(images, self.max_batch)]
+
+        for _, _, queued in pending:
+            queue_wait.observe(started - queued)
+
+        self.running += 1
+
+        try:
+            embeddings = await run_inference(embed_batches, batches)
+        except Exception as error:
+            for _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(error)
+
+            return
+
+        finally:
+            self.running -= 1
+
+        batch_size.observe(len(images))
+        inference_seconds.observe(time.perf_counter() - started)
+        offset = 0
+
+        # Hand every caller back its own slice
+        for request, future, _ in pending:
+            # The caller may have gone away in the meantime
+            if not future.done():
+                future.set_result(embeddings[offset : offset + len(request)])
+
+            offset += len(request)
+
+    def stats(self) -> dict:
+        # Since startup, /metrics has the distributions
+        def summary(count: int, total: float, scale: float = 1) -> dict:
+            return {"count": count, "mean": total * scale / count if count else None}
+
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+            "queued": self.queue.qsize(),
+            "running": self.running,
+            "batch_size": summary(*batch_size.snapshot()),
+            "queue_wait_ms": summary(*queue_wait.snapshot(), 1000),
+        }
+
+
+batcher = Batcher(MAX_BATCH, MAX_WAIT)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    task = asyncio.create_task(batcher.run(WORKERS))
+    yield
+    task.cancel()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(ServerTiming)
+
+
+def embeddings_response(request: Request, embeddings: np.ndarray, boxes: list | None = None):
+    # JSON stays the default so the API is easy to poke at with curl
+    if BINARY not in request.headers.get("accept", ""):
+        return None
+
+    rows, dims = embeddings.shape
+    headers = {"X-Embedding-Shape": f"{rows},{dims}"}
+    body = embeddings.astype("<f4").tobytes()
+
+    # Boxes grow with photos × cards, too big for a header, so they go ahead
+    # of the rows as JSON, padded with spaces to keep the floats aligned
+    if boxes is not None:
+        prefix = json.dumps(boxes).encode()
+        prefix += b" " * (-len(prefix) % 4)
+
+        headers["X-Boxes-Length"] = str(len(prefix))
+        body = prefix + body
+
+    return Response(body, media_type=BINARY, headers=headers)
 
 
 def load_images(paths: tuple[str, ...]):
+    tensors.refresh()
     imgs = []
 
     for path in paths:
+        # Skips decoding and resizing for reference images preprocessed already
+        if (pixels := tensors.get(path, INPUT_SIZE)) is not None:
+            tensor_lookups.inc(result="hit")
+            imgs.append(pixels)
+            continue
+
+        tensor_lookups.inc(result="miss")
+
         img = Image.open(path)
 
         if img.mode != "RGB":
@@ -46,17 +231,66 @@ def load_images(paths: tuple[str, ...]):
 
 
 @app.post("/embed")
-async def embed(images: list[str], batch_size: int = 128):
-    result = []
+async def embed(request: Request, images: list[str]):
+    with timed("load"):
+        loaded = load_images(tuple(images))
+
+    with timed("dino"):
+        result = await batcher.embed(loaded)
 
-    for batch in batched(images, batch_size):
-        imgs = load_images(batch)
-        features = get_embeddings(imgs)
-        result += features
+    if response := embeddings_response(request, result):
+        return response
 
-    return result
+    return result.tolist()
 
 
 @app.post("/bbox")
 async def bbox(img: str):
-    return find_all_cards_from_obbox(img)
+    with timed("yolo"):
+        return await run_inference(find_all_cards_from_obbox, img)
+
+
+@app.post("/detect-embed")
+async def detect_embed(request: Request, images: list[UploadFile]):
+    with timed("upload"):
+        photos = [await image.read() for image in images]
+
+    # One batched detection pass for all the photos
+    with timed("yolo"):
+        found = await run_inference(find_all_cards_in_memory_batch, photos)
+
+    boxes = [each for each, _ in found]
+    crops = [crop for _, cropped in found for crop in cropped]
+
+    with timed("dino"):
+        embeddings = await batcher.embed(crops)
+
+    # Embeddings are flat across images, boxes tell which image they came from
+    if response := embeddings_response(request, embeddings, boxes):
+        return response
+
+    return {"boxes": boxes, "embeddings": embeddings.tolist()}
+
+
+@app.post("/crop")
+async def crop(img: str, points: list[list[float]] = Body()):
+    with timed("crop"):
+        jpeg = await run_inference(encode_crop, img, points)
+
+    return Response(jpeg, media_type="image/jpeg")
+
+
+@app.get("/stats")
+async def stats():
+    return batcher.stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/version")
+async def version():
+    # Lets clients key cached detections and embeddings on the models used
+    return {"embedder": f"{MODEL}:{BACKEND}", "detector": detector_version()}
@@ -0,0 +1,179 @@
+import argparse
+import json
+import os
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from itertools import batched, repeat
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageFile
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+# Reference images decoded and resized to the model's input resolution once,
+# so index rebuilds only pay for inference. Build with
+# `python tiny-embed-server/tensors.py`, the server picks the result up.
+TENSORS = Path(os.environ.get("EMBED_TENSOR_CACHE", Path.home() / ".cache/third-eye/tensors"))
+IMAGES = Path.home() / ".cache/third-eye/images"
+
+MANIFEST = "manifest.json"
+SIZE = (224, 224)  # height, width DINOv3's processor resizes to
+SHARD_SIZE = 2048  # images per shard, ~300 MB at 224x224
+CHUNK_SIZE = 64  # images per decode task
+
+
+def stamp(path: Path) -> str:
+    stat = path.stat()
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def read_manifest(root: Path) -> dict:
+    try:
+        return json.loads((root / MANIFEST).read_text())
+    except FileNotFoundError:
+        return {"size": None, "shards": [], "images": {}}
+
+
+def write_manifest(root: Path, manifest: dict):
+    tmp = root / f"{MANIFEST}.tmp"
+    tmp.write_text(json.dumps(manifest))
+    tmp.replace(root / MANIFEST)
+
+
+class TensorCache:
+    def __init__(self, root: Path = TENSORS):
+        self.root = root
+        self.loaded: int | None = None
+        self.size: tuple[int, int] | None = None
+        self.shards: list[np.ndarray] = []
+
+        # Image file name -> shard, row and the stamp of the file it came from
+        self.images: dict[str, tuple[int, int, str]] = {}
+
+    def refresh(self):
+        # Cheap when nothing changed, picks up builds that ran since
+        try:
+            mtime = (self.root / MANIFEST).stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+
+        if mtime == self.loaded:
+            return
+
+        manifest = read_manifest(self.root)
+
+        self.size = tuple(manifest["size"])  # type: ignore
+        self.shards = [np.load(self.root / shard, mmap_mode="r") for shard in manifest["shards"]]
+        self.images = {name: tuple(entry) for name, entry in manifest["images"].items()}  # type: ignore
+        self.loaded = mtime
+
+    def get(self, path: str, size: tuple[int, int]) -> np.ndarray | None:
+        if self.size != size or (entry := self.images.get(Path(path).name)) is None:
+            return None
+
+        shard, row, source = entry
+
+        # The image was downloaded again since it was preprocessed
+        try:
+            if stamp(Path(path)) != source:
+                return None
+        except FileNotFoundError:
+            return None
+
+        return self.shards[shard][row]
+
+
+def resize(path: Path, size: tuple[int, int]) -> np.ndarray:
+    with Image.open(path) as img:
+        # PIL's antialiased bilinear is what torchvision's resize is built to match
+        resized = img.convert("RGB").resize((size[1], size[0]), Image.Resampling.BILINEAR)
+
+    return np.asarray(resized, dtype=np.uint8)
+
+
+def resize_all(paths: tuple[Path, ...], size: tuple[int, int]) -> np.ndarray:
+    return np.stack([resize(path, size) for path in paths])
+
+
+def build(
+    images: Iterable[Path],
+    root: Path = TENSORS,
+    size: tuple[int, int] = SIZE,
+    workers: int | None = None,
+    shard_size: int = SHARD_SIZE,
+):
+    root.mkdir(parents=True, exist_ok=True)
+    manifest = read_manifest(root)
+
+    # Another input resolution makes every shard useless. Only what the
+    # manifest lists is ours to delete, --out may hold anything else.
+    if manifest["size"] not in (None, list(size)):
+        stale = manifest["shards"]
+
+        # Emptied first, so the server never looks for a deleted shard
+        manifest = {"size": list(size), "shards": [], "images": {}}
+        write_manifest(root, manifest)
+
+        for shard in stale:
+            (root / shard).unlink(missing_ok=True)
+
+    manifest["size"] = list(size)
+
+    done = manifest["images"]
+    todo = [path for path in images if path.name not in done or done[path.name][2] != stamp(path)]
+
+    print(f"{len(done)} images preprocessed already, {len(todo)} to go")
+
+    shard = np.empty((shard_size, *size, 3), dtype=np.uint8)
+    names: list[tuple[str, str]] = []
+
+    def flush():
+        number = len(manifest["shards"])
+        name = f"{number:05}.npy"
+
+        tmp = root / f"{name}.tmp"
+
+        with tmp.open("wb") as f:
+            np.save(f, shard[: len(names)])
+
+        tmp.replace(root / name)
+
+        manifest["shards"].append(name)
+        done.update((image, [number, row, source]) for row, (image, source) in enumerate(names))
+
+        # Written after every shard, so an interrupted build keeps its progress
+        write_manifest(root, manifest)
+        names.clear()
+
+    chunks = list(batched(todo, CHUNK_SIZE))
+
+    with ProcessPoolExecutor(workers) as pool:
+        for processed, (chunk, resized) in enumerate(zip(chunks, pool.map(resize_all, chunks, repeat(size)))):
+            for path, pixels in zip(chunk, resized):
+                shard[len(names)] = pixels
+                names.append((path.name, stamp(path)))
+
+                if len(names) == shard_size:
+                    flush()
+
+            print(f"{min((processed + 1) * CHUNK_SIZE, len(todo))}/{len(todo)} images preprocessed", end="\r")
+
+    if names:
+        flush()
+
+    print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decode and resize reference images once for index builds")
+    parser.add_argument("images", nargs="?", type=Path, default=IMAGES)
+    parser.add_argument("--out", type=Path, default=TENSORS)
+    parser.add_argument("--size", type=int, nargs=2, default=SIZE, metavar=("HEIGHT", "WIDTH"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE)
+    args = parser.parse_args()
+
+    # Not the .tmp files of downloads still being written
+    paths = sorted(path for path in args.images.iterdir() if path.is_file() and path.suffix != ".tmp")
+    build(paths, args.out, tuple(args.size), args.workers, args.shard_size)
@@ -1,4 +1,10 @@
-type QueueItem = { id: number; object_id: string; created_at: string };
+type QueueItem = {
+  id: number;
+  object_id: string;
+  created_at: string;
+  status: "pending" | "processing" | "done" | "failed";
+  error: string | null;
+};
 
 const postFile = async (endpoint: string, file: File) => {
   const form = new FormData();
@@ -16,10 +22,32 @@ const uploadImage = async (file: File): Promise<string> => {
   return postFile("/upload-image", file);
 };
 
+type SearchFilter = {
+  sets?: string[];
+  lang?: string;
+  session?: string;
+};
+
 const findSimilar = async (
   id: string,
+  filter: SearchFilter = {},
 ): Promise<{ img: string; matches: { id: string; score: number }[] }[]> => {
-  const response = await fetch(`/api/similar-from-image/${id}`);
+  const params = new URLSearchParams();
+
+  for (const set of filter.sets ?? []) {
+    params.append("set", set);
+  }
+
+  if (filter.lang) {
+    params.set("lang", filter.lang);
+  }
+
+  if (filter.session) {
+    params.set("session", filter.session);
+  }
+
+  const query = params.size ? `?${params}` : "";
+  const response = await fetch(`/api/similar-from-image/${id}${query}`);
   return response.json();
 };
 
@@ -29,6 +57,15 @@ const putMatch = async (id: string, src: string, session: string) => {
   return response.json();
 };
 
+const putMatches = async (matches: { id: string; src: string; session: string }[]) => {
+  const response = await fetch(`/api/matches`, {
+    method: "PUT",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(matches),
+  });
+  return response.json();
+};
+
 const getCards = async (ids: string[], f = fetch) => {
   const query = ids.map((id) => `ids=${id}`).join("&");
   const response = await f(`/api/cards?${query}`);
@@ -46,7 +83,8 @@ const listSessions = async (f = fetch) => {
   return response.json();
 };
 
-const makeTmpImageUrl = (image: string) => `/api/tmp/images/${image.slice(5)}`;
+// Older results carry a .tmp/ prefix, the crop name is what comes after it
+const makeTmpImageUrl = (image: string) => `/api/crops/${image.split("/").pop()}`;
 
 const getCollection = async (f = fetch) => {
   const response = await f(`/api/collection`);
@@ -77,11 +115,12 @@ const newSession = async (f = fetch): Promise<string> => {
   return response.json();
 };
 
-export type { QueueItem };
+export type { QueueItem, SearchFilter };
 export {
   uploadImage,
   findSimilar,
   putMatch,
+  putMatches,
   getCards,
   loadSession,
   listSessions,